@@ -0,0 +1,179 @@
+import numpy as np
+
+from metrics import timed
+from randomness import get_rng
+from app_functions import (all_pairings, phi_plus, phi_minus, psi_plus, psi_minus,
+                           phi_plus_reverse, phi_minus_reverse, psi_plus_reverse, psi_minus_reverse)
+
+# "aer" runs the Qiskit circuits and stays the reference, "analytic" samples
+# from exact outcome probabilities computed once with NumPy
+backends = ("aer", "analytic")
+
+#######################################
+# Minimal NumPy statevector simulator #
+#######################################
+hadamard = np.array([[1, 1], [1, -1]], dtype=complex) / np.sqrt(2)
+pauli_x = np.array([[0, 1], [1, 0]], dtype=complex)
+pauli_z = np.array([[1, 0], [0, -1]], dtype=complex)
+phase_s = np.array([[1, 0], [0, 1j]], dtype=complex)
+phase_t = np.array([[1, 0], [0, np.exp(1j * np.pi / 4)]], dtype=complex)
+
+class StatevectorCircuit:
+    # Exposes the gate methods the Bell-state helpers call on a QuantumCircuit,
+    # applying them to a little-endian statevector (qubit 0 is the last axis)
+    def __init__(self, n_qubits):
+        self.n_qubits = n_qubits
+        self.state = np.zeros((2,) * n_qubits, dtype=complex)
+        self.state[(0,) * n_qubits] = 1
+
+    def _axis(self, qubit):
+        return self.n_qubits - 1 - qubit
+
+    def apply(self, gate, qubit):
+        axis = self._axis(qubit)
+        self.state = np.moveaxis(np.tensordot(gate, self.state, axes=([1], [axis])), 0, axis)
+
+    def h(self, qubit):
+        self.apply(hadamard, qubit)
+
+    def x(self, qubit):
+        self.apply(pauli_x, qubit)
+
+    def z(self, qubit):
+        self.apply(pauli_z, qubit)
+
+    def s(self, qubit):
+        self.apply(phase_s, qubit)
+
+    def sdg(self, qubit):
+        self.apply(phase_s.conj().T, qubit)
+
+    def t(self, qubit):
+        self.apply(phase_t, qubit)
+
+    def tdg(self, qubit):
+        self.apply(phase_t.conj().T, qubit)
+
+    def cx(self, control, target):
+        index = [slice(None)] * self.n_qubits
+        index[self._axis(control)] = 1
+        controlled = self.state[tuple(index)]
+        target_axis = self._axis(target) - (self._axis(target) > self._axis(control))
+        self.state[tuple(index)] = np.flip(controlled, axis=target_axis).copy()
+
+    def project(self, qubit, value):
+        # Collapses qubit onto |value> and returns the probability of that outcome
+        index = [slice(None)] * self.n_qubits
+        index[self._axis(qubit)] = 1 - value
+        self.state[tuple(index)] = 0
+        probability = float(np.sum(np.abs(self.state) ** 2))
+        if probability > 0:
+            self.state /= np.sqrt(probability)
+        return probability
+
+    def probabilities(self):
+        # Flattening the (q_{n-1}, ..., q_0) axes gives the usual basis-state index
+        return np.abs(self.state.reshape(-1)) ** 2
+
+########
+# BB84 #
+########
+def bb84_probabilities():
+    # P(Bob measures 1 | Alice's bit, Alice's basis, Bob's basis)
+    table = np.zeros((2, 2, 2))
+    for bit in range(2):
+        for alice_basis in range(2):
+            for bob_basis in range(2):
+                sv = StatevectorCircuit(1)
+                if bit == 1:
+                    sv.x(0)
+                if alice_basis == 1:
+                    sv.h(0)
+                if bob_basis == 1:
+                    sv.h(0)
+                table[bit, alice_basis, bob_basis] = sv.probabilities()[1]
+    return table
+
+bb84_table = bb84_probabilities()
+
+@timed("simulate")
+def sample_bb84(alice_bits, alice_basis, bob_basis, rng=None):
+    rng = rng or get_rng()
+    p_one = bb84_table[alice_bits, alice_basis, bob_basis]
+    return (rng.random(len(alice_bits)) < p_one).astype(np.uint8)
+
+#######
+# E91 #
+#######
+# Gate sequences of Alice's (qubit 0) and Bob's (qubit 1) measurement circuits
+e91_alice_measurements = [["h"], ["s", "h", "t", "h"], []]
+e91_bob_measurements = [["s", "h", "t", "h"], [], ["s", "h", "tdg", "h"]]
+
+def e91_probabilities():
+    # P(outcome | Alice's choice, Bob's choice), outcome = 2 * cr[1] + cr[0]
+    table = np.zeros((3, 3, 4))
+    for a, alice_gates in enumerate(e91_alice_measurements):
+        for b, bob_gates in enumerate(e91_bob_measurements):
+            sv = StatevectorCircuit(2)
+            sv.x(0)
+            sv.x(1)
+            sv.h(0)
+            sv.cx(0, 1)
+            for gate in alice_gates:
+                getattr(sv, gate)(0)
+            for gate in bob_gates:
+                getattr(sv, gate)(1)
+            table[a, b] = sv.probabilities()
+    return table
+
+e91_table = e91_probabilities()
+e91_cumulative = np.cumsum(e91_table, axis=2)
+
+@timed("simulate")
+def sample_e91(alice_choices, bob_choices, rng=None):
+    # Choices are 1-based like in simulate_e91_protocol; returns outcome indices 0..3
+    rng = rng or get_rng()
+    cdf = e91_cumulative[np.asarray(alice_choices) - 1, np.asarray(bob_choices) - 1]
+    u = rng.random(len(cdf))
+    return np.minimum((u[:, None] >= cdf).sum(axis=1), 3).astype(np.uint8)
+
+######
+# BS #
+######
+bs_entangling_states = {0: (phi_plus, phi_minus), 1: (phi_minus, phi_plus),
+                        2: (psi_plus, psi_minus), 3: (psi_minus, psi_plus)}
+bs_reversal_states = {0: (phi_plus_reverse, phi_minus_reverse), 1: (phi_minus_reverse, phi_plus_reverse),
+                      2: (psi_plus_reverse, psi_minus_reverse), 3: (psi_minus_reverse, psi_plus_reverse)}
+
+def bs_outcome_table():
+    # Same layout as app_functions.get_outcome_table: [alice pairing, alice group, bob pairing, bob group]
+    table = np.zeros((len(all_pairings), 4, len(all_pairings), 4), dtype=bool)
+    for alice_p, (alice_first, alice_second) in enumerate(all_pairings):
+        for alice_gc, (alice_bell1, alice_bell2) in bs_entangling_states.items():
+            for bob_p, (bob_first, bob_second) in enumerate(all_pairings):
+                for bob_gc, (bob_bell1, bob_bell2) in bs_reversal_states.items():
+                    sv = StatevectorCircuit(4)
+                    alice_bell1(alice_first[0], alice_first[1], sv)
+                    alice_bell2(alice_second[0], alice_second[1], sv)
+                    bob_bell1(bob_first[0], bob_first[1], sv)
+                    bob_bell2(bob_second[0], bob_second[1], sv)
+                    table[alice_p, alice_gc, bob_p, bob_gc] = np.isclose(sv.probabilities()[0], 1)
+    return table
+
+bs_table = bs_outcome_table()
+
+@timed("simulate")
+def sample_bs(n_pairings, grouping_choices=4, rng=None):
+    # Returns the grouping codes of the pairings Bob guessed correctly
+    rng = rng or get_rng()
+    alice_p = rng.integers(len(all_pairings), size=n_pairings)
+    alice_gc = rng.integers(grouping_choices, size=n_pairings)
+    bob_p = rng.integers(len(all_pairings), size=n_pairings)
+    bob_gc = rng.integers(grouping_choices, size=n_pairings)
+    correct = bs_table[alice_p, alice_gc, bob_p, bob_gc]
+    return alice_gc[correct], bob_gc[correct]
+
+def groupings_to_bits(groupings):
+    # Vectorized generate_code: each grouping contributes its two bits, high bit first
+    groupings = np.asarray(groupings, dtype=np.uint8)
+    return np.stack([groupings >> 1, groupings & 1], axis=1).reshape(-1)
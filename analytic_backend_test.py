@@ -0,0 +1,80 @@
+import numpy as np
+from qiskit import Aer
+
+from analytic_backend import bs_table, e91_table, sample_bb84, sample_bs, sample_e91
+from app_functions import get_outcome_table
+from generate_bb84_key import measure_qubits_aer
+from generate_e91_key import build_e91_circuits, e91_qkd_protocol
+
+
+def within_sampling_error(observed, expected, shots):
+    # Five standard deviations of a binomial proportion, plus a floor for p close to 0 or 1
+    tolerance = 5 * np.sqrt(expected * (1 - expected) / shots) + 1e-3
+    return np.all(np.abs(observed - expected) <= tolerance)
+
+
+def test_bs_table_matches_aer_table():
+    assert np.array_equal(bs_table, get_outcome_table())
+
+
+def test_e91_probabilities_match_aer_counts():
+    shots = 4000
+    singlet, alice_measurements, bob_measurements = build_e91_circuits()
+    circuits = [singlet.compose(alice).compose(bob) for alice in alice_measurements for bob in bob_measurements]
+    result = Aer.get_backend('qasm_simulator').run(circuits, shots=shots).result()
+
+    for i, expected in enumerate(e91_table.reshape(9, 4)):
+        observed = np.zeros(4)
+        for bitstring, count in result.get_counts(i).items():
+            observed[int(bitstring[-2:], 2)] += count / shots
+        assert within_sampling_error(observed, expected, shots)
+
+
+def test_e91_sampler_matches_probabilities():
+    n = 90000
+    rng = np.random.default_rng(1)
+    alice_choices = rng.integers(1, 4, size=n)
+    bob_choices = rng.integers(1, 4, size=n)
+    outcomes = sample_e91(alice_choices, bob_choices, rng=rng)
+    for a in range(3):
+        for b in range(3):
+            selected = outcomes[(alice_choices == a + 1) & (bob_choices == b + 1)]
+            observed = np.bincount(selected, minlength=4) / len(selected)
+            assert within_sampling_error(observed, e91_table[a, b], len(selected))
+
+
+def test_bb84_sampler_matches_aer():
+    n = 20000
+    rng = np.random.default_rng(2)
+    alice_bits, alice_basis, bob_basis = (rng.integers(2, size=n).astype(np.uint8) for _ in range(3))
+    aer_results = measure_qubits_aer(alice_bits, alice_basis, bob_basis)
+    analytic_results = sample_bb84(alice_bits, alice_basis, bob_basis, rng=rng)
+
+    matching = alice_basis == bob_basis
+    assert np.array_equal(aer_results[matching], alice_bits[matching])
+    assert np.array_equal(analytic_results[matching], alice_bits[matching])
+    aer_agreement = np.mean(aer_results[~matching] == alice_bits[~matching])
+    analytic_agreement = np.mean(analytic_results[~matching] == alice_bits[~matching])
+    assert within_sampling_error(np.array([aer_agreement, analytic_agreement]), 0.5, np.sum(~matching))
+
+
+def test_bs_sampler_only_returns_correct_guesses():
+    alice_groupings, bob_groupings = sample_bs(12000, rng=np.random.default_rng(3))
+    assert np.array_equal(alice_groupings, bob_groupings)
+    # Bob guesses Alice's pairing and grouping with probability 1/12
+    assert within_sampling_error(len(alice_groupings) / 12000, 1 / 12, 12000)
+
+
+def test_e91_backends_produce_matching_keys():
+    for backend in ("aer", "analytic"):
+        alice_key, bob_key = e91_qkd_protocol(64, backend=backend)
+        assert len(alice_key) == 64
+        assert alice_key == bob_key
+
+
+def test_bs_keys_use_both_bits_of_every_grouping():
+    from generate_bs_key import bs_qkd_protocol
+    for backend in ("aer", "analytic"):
+        bits = bs_qkd_protocol(4000, backend=backend, rng=np.random.default_rng(1))[0].to_bits()
+        # The high and the low bit of the grouping codes are both uniform
+        assert 0.4 < bits[0::2].mean() < 0.6 and 0.4 < bits[1::2].mean() < 0.6
@@ -1,4 +1,5 @@
 from fastapi.testclient import TestClient
+import time
 import pytest
 from generate_key import app
 
@@ -14,3 +15,166 @@ def test_get_key():
     assert len(response.json()["alice_key"]) == 64
     assert len(response.json()["bob_key"]) == 64
 
+
+def test_get_bs_key():
+    response = client.get("/bs_key/64")
+    assert response.status_code == 200
+    assert len(response.json()["alice_key"]) == 64
+    assert response.json()["alice_key"] == response.json()["bob_key"]
+
+def test_get_bs_key_rejects_unknown_mode():
+    response = client.get("/bs_key/64?mode=unknown")
+    assert response.status_code == 400
+
+def test_get_bs_key_batched_round():
+    response = client.get("/bs_key/32?mode=batched&round_size=200")
+    assert response.status_code == 200
+    assert len(response.json()["alice_key"]) == 32
+    assert response.json()["alice_key"] == response.json()["bob_key"]
+
+def test_get_bb84_key():
+    response = client.get("/bb84_key/64")
+    assert response.status_code == 200
+    assert len(response.json()["alice_key"]) == 64
+    assert response.json()["alice_key"] == response.json()["bob_key"]
+
+def test_analytic_backend_for_every_protocol():
+    for protocol in ("bs", "bb84", "e91"):
+        response = client.get(f"/{protocol}_key/256?backend=analytic")
+        assert response.status_code == 200
+        assert len(response.json()["alice_key"]) == 256
+        assert response.json()["alice_key"] == response.json()["bob_key"]
+
+def test_unknown_backend_is_rejected():
+    response = client.get("/e91_key/64?backend=unknown")
+    assert response.status_code == 400
+
+def test_get_e91_key_reports_chsh():
+    response = client.get("/e91_key/64")
+    assert response.status_code == 200
+    assert response.json()["alice_key"] == response.json()["bob_key"]
+    assert response.json()["key_mismatches"] == 0
+    assert response.json()["chsh"] < -2
+
+def test_post_processed_keys_report_leaked_bits():
+    for protocol in ("bs", "bb84", "e91"):
+        response = client.get(f"/{protocol}_key/128?backend=analytic&post_process=true")
+        assert response.status_code == 200
+        assert len(response.json()["alice_key"]) == 128
+        assert response.json()["alice_key"] == response.json()["bob_key"]
+        assert response.json()["post_processing"]["leaked_bits"] > 0
+
+def test_channel_statistics_with_eavesdropper():
+    response = client.get("/channel_statistics/bb84/100000?interception=1")
+    assert response.status_code == 200
+    assert abs(response.json()["qber"] - 0.25) < 0.02
+    response = client.get("/channel_statistics/e91/100000?depolarizing=0.1")
+    assert response.status_code == 200
+    assert -2.7 < response.json()["chsh"] < -2.3
+    assert client.get("/channel_statistics/bb84/1000?loss=2").status_code == 400
+    assert client.get("/channel_statistics/bs/1000").status_code == 400
+
+def test_saturated_pool_returns_503(monkeypatch):
+    from generate_key import worker_pool
+    monkeypatch.setattr(worker_pool, "max_pending", 0)
+    response = client.get("/bb84_key/64")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(worker_pool.retry_after)
+
+def test_key_pool_status_lists_every_protocol():
+    response = client.get("/key_pool")
+    assert response.status_code == 200
+    assert set(response.json()) == {"BS", "BB84", "E91"}
+    assert "depth" in response.json()["BB84"]
+    assert "refill_rate" in response.json()["BB84"]
+
+def test_keys_are_served_from_a_filled_pool():
+    with TestClient(app) as pooled_client:
+        from generate_key import key_pools
+        for _ in range(200):
+            if key_pools["BB84"].depth >= 64:
+                break
+            time.sleep(0.05)
+        response = pooled_client.get("/bb84_key/64")
+        assert response.status_code == 200
+        assert response.json()["from_pool"]
+        assert response.json()["alice_key"] == response.json()["bob_key"]
+
+
+def test_metrics_include_worker_stages():
+    client.get("/e91_key/64?backend=aer")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    for stage in ("simulate", "decode", "sift"):
+        assert f'qkd_stage_seconds_count{{stage="{stage}"}}' in response.text
+    jobs = next(line for line in response.text.splitlines() if line.startswith("qkd_simulator_jobs_total "))
+    assert int(jobs.split()[1]) >= 1
+    assert 'qkd_key_pool_requests_total{protocol="E91",result=' in response.text
+
+
+def test_key_jobs_run_in_the_background():
+    with TestClient(app) as jobs_client:
+        response = jobs_client.post("/jobs", json={"protocol": "E91", "key_length": 300,
+                                                   "options": {"backend": "analytic"}})
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        assert response.json()["state"] in ("queued", "running")
+
+        status = jobs_client.get(f"/jobs/{job_id}?wait=30").json()
+        assert status["state"] == "done" and status["generated_bits"] == 300
+        keys = jobs_client.get(f"/jobs/{job_id}/keys").json()
+        assert len(keys["alice_key"]) == 300 and keys["alice_key"] == keys["bob_key"]
+        assert job_id in [job["job_id"] for job in jobs_client.get("/jobs").json()["jobs"]]
+
+
+def test_key_jobs_can_be_cancelled():
+    from generate_key import key_jobs
+    with TestClient(app) as jobs_client:
+        running = key_jobs.max_running
+        key_jobs.max_running = 0
+        try:
+            job_id = jobs_client.post("/jobs", json={"protocol": "BB84", "key_length": 1024}).json()["job_id"]
+            assert jobs_client.delete(f"/jobs/{job_id}").json()["state"] == "cancelled"
+            assert jobs_client.get(f"/jobs/{job_id}/keys").status_code == 409
+        finally:
+            key_jobs.max_running = running
+
+
+def test_key_job_requests_are_validated():
+    assert client.post("/jobs", json={"protocol": "B92", "key_length": 64}).status_code == 400
+    assert client.post("/jobs", json={"protocol": "BB84", "key_length": 0}).status_code == 400
+    assert client.post("/jobs", json={"protocol": "BB84", "key_length": 64,
+                                      "options": {"mode": "grouped"}}).status_code == 400
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_batch_keys_are_split_from_one_run_per_protocol():
+    requests = [{"protocol": "BB84", "key_length": 64}, {"protocol": "E91", "key_length": 40},
+                {"protocol": "BB84", "key_length": 100}, {"protocol": "BS", "key_length": 30,
+                                                          "options": {"backend": "analytic"}}]
+    response = client.post("/batch_keys", json={"requests": requests})
+    assert response.status_code == 200
+    assert response.json()["simulation_runs"] == 3
+    keys = response.json()["keys"]
+    assert [key["protocol"] for key in keys] == ["BB84", "E91", "BB84", "BS"]
+    assert [len(key["alice_key"]) for key in keys] == [64, 40, 100, 30]
+    assert all(key["alice_key"] == key["bob_key"] for key in keys)
+    assert keys[0]["alice_key"] != keys[2]["alice_key"][:64]
+
+
+def test_batch_keys_are_validated():
+    assert client.post("/batch_keys", json={"requests": []}).status_code == 400
+    assert client.post("/batch_keys", json={"requests": [{"protocol": "B92", "key_length": 8}]}).status_code == 400
+    for round_size in (True, 1.5, 0):
+        request = {"protocol": "BS", "key_length": 8, "options": {"round_size": round_size}}
+        assert client.post("/batch_keys", json={"requests": [request]}).status_code == 400
+        assert client.post("/jobs", json=request).status_code == 400
+
+
+def test_short_e91_keys_and_lossy_channels_are_valid_json():
+    for _ in range(30):
+        assert client.get("/e91_key/1?backend=analytic").status_code == 200
+    response = client.get("/channel_statistics/e91/1000?loss=1")
+    assert response.status_code == 200
+    assert response.json()["chsh"] is None
@@ -1,165 +1,193 @@
 import streamlit as st
 from app_functions import *
-from qiskit import QuantumRegister, ClassicalRegister, QuantumCircuit, Aer
+from qiskit import QuantumRegister, ClassicalRegister, QuantumCircuit
 from qiskit.visualization import circuit_drawer
-from PIL import Image
+import matplotlib.pyplot as plt
 import io
+import os
+import time
+from key_jobs import KeyJob, job_protocol_functions
+from worker_pool import WorkerPool
 
-def page_bell_states():
-    st.title("Bell States")
-    with st.container(border=True):
-        q = QuantumRegister(2)
-        b = ClassicalRegister(2)
-        qc1 = QuantumCircuit(q, b)
-        qc2 = QuantumCircuit(q, b)
-        qc3 = QuantumCircuit(q, b)
-        qc4 = QuantumCircuit(q, b)
-
-        phi_plus(q[0], q[1], qc1)
-        phi_minus(q[0], q[1], qc2)
-        psi_plus(q[0], q[1], qc3)
-        psi_minus(q[0], q[1], qc4)
-
-        for qc, state in zip([qc1, qc2, qc3, qc4], ['Phi Plus', 'Phi Minus', 'Psi Plus', 'Psi Minus']):
-            with st.container(border=True):
-                col1, col2 = st.columns([1,2])
-                with col1:
-                    st.header(state)
-                with col2:
-                    image = circuit_drawer(qc, output='mpl')
-                    byte_array = io.BytesIO()
-                    image.savefig(byte_array, format='PNG')
-                    image = Image.open(byte_array)
-                    st.image(image)
+# The diagrams never change, so each one is rendered to PNG once per server process and
+# shared by every session. Figures are closed right after rendering.
+bell_state_builders = {'Phi Plus': phi_plus, 'Phi Minus': phi_minus, 'Psi Plus': psi_plus, 'Psi Minus': psi_minus}
+group_builders = {'Group 00': circuit00, 'Group 01': circuit01, 'Group 10': circuit10, 'Group 11': circuit11}
 
-def page_entangled_states():
-    st.title("Entangled Bell States")
-    with st.container(border=True):
-        q = QuantumRegister(4)
-        b = ClassicalRegister(4)
-        pairs = Pairing([0, 1], [2, 3])
+def build_bell_state_circuit(state):
+    q = QuantumRegister(2)
+    b = ClassicalRegister(2)
+    qc = QuantumCircuit(q, b)
+    bell_state_builders[state](q[0], q[1], qc)
+    return qc
 
-        qc1, _ = circuit00(pairs)
-        qc2, _ = circuit01(pairs)
-        qc3, _ = circuit10(pairs)
-        qc4, _ = circuit11(pairs)
+def build_group_circuit(group):
+    qc, _ = group_builders[group](Pairing([0, 1], [2, 3]))
+    return qc
 
-        for qc, state in zip([qc1, qc2, qc3, qc4], ['Group 00', 'Group 01', 'Group 10', 'Group 11']):
-            with st.container(border=True):
-                col1, col2 = st.columns([1,2])
-                with col1:
-                    st.header(state)
-                with col2:
-                    image = circuit_drawer(qc, output='mpl')
-                    byte_array = io.BytesIO()
-                    image.savefig(byte_array, format='PNG')
-                    image = Image.open(byte_array)
-                    st.image(image)
+def build_final_circuit():
+    q = QuantumRegister(4)
+    b = ClassicalRegister(4)
+    qc = QuantumCircuit(q, b)
 
-def page_final_circuit():
-    st.title("Final Circuit which generates a 2-bit key")
-    with st.container(border=True):
-        q = QuantumRegister(4)
-        b = ClassicalRegister(4)
-        qc = QuantumCircuit(q, b)
+    # Alice applies a particular pairing and grouping to generate a Bell state
+    # For example, let's generate the Bell state for group 00 (phi_plus and phi_minus)
+
+    # Apply a Hadamard gate to the first qubit of the first pair
+    qc.h(q[0])
+
+    # Apply a CNOT gate with the first qubit of the first pair as control and the second qubit as target
+    qc.cx(q[0], q[1])
 
-        # Alice applies a particular pairing and grouping to generate a Bell state
-        # For example, let's generate the Bell state for group 00 (phi_plus and phi_minus)
+    # Apply an X gate to the first qubit of the second pair
+    qc.x(q[2])
 
-        # Apply a Hadamard gate to the first qubit of the first pair
-        qc.h(q[0])
+    # Apply a Hadamard gate to the first qubit of the second pair
+    qc.h(q[2])
 
-        # Apply a CNOT gate with the first qubit of the first pair as control and the second qubit as target
-        qc.cx(q[0], q[1])
+    # Apply a CNOT gate with the first qubit of the second pair as control and the second qubit as target
+    qc.cx(q[2], q[3])
 
-        # Apply an X gate to the first qubit of the second pair
-        qc.x(q[2])
+    # Bob applies the reverse circuit
+    # For the reverse circuit of group 00 (phi_plus_reverse and phi_minus_reverse)
 
-        # Apply a Hadamard gate to the first qubit of the second pair
-        qc.h(q[2])
+    # Apply a CNOT gate with the first qubit of the first pair as control and the second qubit as target
+    qc.cx(q[0], q[1])
 
-        # Apply a CNOT gate with the first qubit of the second pair as control and the second qubit as target
-        qc.cx(q[2], q[3])
+    # Apply a Hadamard gate to the first qubit of the first pair
+    qc.h(q[0])
 
-        # Bob applies the reverse circuit
-        # For the reverse circuit of group 00 (phi_plus_reverse and phi_minus_reverse)
+    # Apply a CNOT gate with the first qubit of the second pair as control and the second qubit as target
+    qc.cx(q[2], q[3])
 
-        # Apply a CNOT gate with the first qubit of the first pair as control and the second qubit as target
-        qc.cx(q[0], q[1])
+    # Apply a Hadamard gate to the first qubit of the second pair
+    qc.h(q[2])
 
-        # Apply a Hadamard gate to the first qubit of the first pair
-        qc.h(q[0])
+    # Apply an X gate to the first qubit of the second pair
+    qc.x(q[2])
 
-        # Apply a CNOT gate with the first qubit of the second pair as control and the second qubit as target
-        qc.cx(q[2], q[3])
+    qc.measure_all()
+    return qc
 
-        # Apply a Hadamard gate to the first qubit of the second pair
-        qc.h(q[2])
+def render_circuit_png(qc):
+    figure = circuit_drawer(qc, output='mpl')
+    byte_array = io.BytesIO()
+    figure.savefig(byte_array, format='PNG')
+    plt.close(figure)
+    return byte_array.getvalue()
 
-        # Apply an X gate to the first qubit of the second pair
-        qc.x(q[2])
+diagram_builders = {"bell": build_bell_state_circuit, "group": build_group_circuit,
+                    "final": lambda name: build_final_circuit()}
 
-        qc.measure_all()
+@st.cache_data(show_spinner=False)
+def diagram_png(kind, name):
+    # Keyed by the circuit's structure (diagram kind and name), not by session
+    return render_circuit_png(diagram_builders[kind](name))
 
-        # Convert the quantum circuit to an image
-        image = circuit_drawer(qc, output='mpl')
+@st.cache_resource(show_spinner="Rendering circuit diagrams...")
+def prerender_diagrams():
+    # Runs once per server process, so page switches only read cached PNG bytes
+    for state in bell_state_builders:
+        diagram_png("bell", state)
+    for group in group_builders:
+        diagram_png("group", group)
+    diagram_png("final", "final")
+    return True
 
-        # Convert image to byte array
-        byte_array = io.BytesIO()
-        image.savefig(byte_array, format='PNG')
+def page_bell_states():
+    st.title("Bell States")
+    with st.container(border=True):
+        for state in bell_state_builders:
+            with st.container(border=True):
+                col1, col2 = st.columns([1,2])
+                with col1:
+                    st.header(state)
+                with col2:
+                    st.image(diagram_png("bell", state))
 
-        # Convert byte array to PIL image
-        image = Image.open(byte_array)
+def page_entangled_states():
+    st.title("Entangled Bell States")
+    with st.container(border=True):
+        for group in group_builders:
+            with st.container(border=True):
+                col1, col2 = st.columns([1,2])
+                with col1:
+                    st.header(group)
+                with col2:
+                    st.image(diagram_png("group", group))
 
-        # Display the image on Streamlit
+def page_final_circuit():
+    st.title("Final Circuit which generates a 2-bit key")
+    with st.container(border=True):
+        # Display the cached image on Streamlit
         col1, col2 = st.columns([1,2])
         with col1:
             st.header('Final Circuit')
         with col2:
-            st.image(image, caption='Final Circuit')
-
-import time
+            st.image(diagram_png("final", "final"), caption='Final Circuit')
+
+# Keys are generated by the API's engine on a worker pool shared by all sessions, so a long
+# key never blocks the page or other users. The page polls the running job for progress.
+app_max_key_bits = int(os.environ.get("QKD_APP_MAX_KEY_BITS", 1 << 24))
+app_refresh_interval = float(os.environ.get("QKD_APP_REFRESH_INTERVAL", 0.25))
+# Only the start of long keys is shown, the full keys can be downloaded
+app_shown_key_bits = 256
+
+@st.cache_resource
+def get_worker_pool():
+    worker_pool = WorkerPool()
+    worker_pool.start()
+    return worker_pool
+
+def show_key(name, key):
+    st.subheader(name)
+    shown = str(key[:app_shown_key_bits])
+    st.code(shown + ("..." if len(key) > app_shown_key_bits else ""), language=None)
+    st.download_button(f"Download {name} ({len(key)} bits)", key.to_bytes(), file_name=f"{name.lower()}_key.bin",
+                       key=f"download_{name}")
+
+def show_key_job(job):
+    progress_bar = st.progress(0.0)
+    status = st.empty()
+    while True:
+        progress = job.progress()
+        progress_bar.progress(progress["generated_bits"] / progress["desired_key_length"])
+        status.write(f"{progress['protocol']}: {progress['generated_bits']} of {progress['desired_key_length']} bits, "
+                     f"{progress['bits_per_second']:,.0f} bits/s, {progress['simulator_jobs']} simulator jobs, "
+                     f"{progress['elapsed']:.2f} s ({progress['state']})")
+        if not job.active:
+            break
+        time.sleep(app_refresh_interval)
+
+    if job.state == "failed":
+        st.error(f"Key generation failed: {job.error}")
+    elif job.state == "done":
+        alice_key, bob_key = job.keys()
+        col1, col2 = st.columns(2)
+        with col1:
+            show_key("Alice", alice_key)
+        with col2:
+            show_key("Bob", bob_key)
+        st.write(f"Mismatching bits: {alice_key.hamming_distance(bob_key)}")
 
 def page_shared_key():
     st.title("Generate Shared Key")
     with st.container(border=True):
-        desired_key_length = st.number_input('Enter desired key length:', min_value=1, max_value=1000, value=10)
+        protocol = st.selectbox('Protocol', list(job_protocol_functions))
+        desired_key_length = st.number_input('Enter desired key length:', min_value=1, max_value=app_max_key_bits,
+                                             value=1024)
 
+        job = st.session_state.get("key_job")
         if st.button('Generate Shared Key', key='generate_shared_key'):
+            if job is not None:
+                job.cancel()
+            job = KeyJob(protocol, int(desired_key_length)).start(get_worker_pool())
+            st.session_state["key_job"] = job
+        if job is not None and job.active and st.button('Cancel', key='cancel_shared_key'):
+            job.cancel()
+        if job is not None:
+            show_key_job(job)
 
-            start_time = time.time()
-
-            alice_code, bob_code = "", ""
-            while len(alice_code) <= desired_key_length:
-                alice_pairings = generate_random_pairings(10)
-                alice_groupings = generate_random_groupings(10)
-                bob_pairings = generate_random_pairings(10)
-                bob_groupings = generate_random_groupings(10)
-
-                alice_json = {"pairings": alice_pairings, "groupings": alice_groupings, "correct_measurements": []}
-                bob_json = {"pairings": bob_pairings, "groupings": bob_groupings, "correct_measurements": []}
-                alice_json, bob_json = quantum_compute(alice_json, bob_json)
-                alice_json, bob_json = quantum_compute(alice_json, bob_json)
-                alice_json["code"] = generate_code(alice_json["correct_measurements"])
-                bob_json["code"] = generate_code(bob_json["correct_measurements"])
-                alice_code += alice_json["code"]
-                bob_code += bob_json["code"]
-
-            alice_code = alice_code[:desired_key_length]
-            bob_code = bob_code[:desired_key_length]
-
-            end_time = time.time()
-            time_taken = end_time - start_time
-
-            col1, col2 = st.columns(2)
-            with col1:
-                st.subheader('Alice Code')
-                st.write(alice_code)
-            with col2:
-                st.subheader('Bob Code')
-                st.write(bob_code)
-
-            st.write(f"Time taken to generate the key: {int(time_taken)} seconds")
 PAGES = {
     "Bell States": page_bell_states,
     "Entangled Bell States": page_entangled_states,
@@ -168,6 +196,7 @@ PAGES = {
 }
 
 def main():
+    prerender_diagrams()
     st.sidebar.title("Navigation")
     choice = st.sidebar.radio("Go to", list(PAGES.keys()))
 
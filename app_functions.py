@@ -1,14 +1,26 @@
-from qiskit import Aer
-from qiskit import execute
-from qiskit.circuit import QuantumRegister, ClassicalRegister, QuantumCircuit
-from qiskit.visualization import circuit_drawer
-from PIL import Image
-import io
-import random
-import json
+import logging
+import numpy as np
+
+from metrics import count, timed
+from randomness import get_rng
+from simulation import get_template, run_circuits
+
+# Qiskit is imported by the functions that build or check circuits, so table lookups
+# and the analytic backend never load it
 
 qbits = 4
 
+all_pairings = [[[0,1], [2,3]], [[0,2], [1,3]], [[0,3], [1,2]]]
+all_pairings_array = np.array(all_pairings)
+pairing_index = {((0,1), (2,3)): 0, ((0,2), (1,3)): 1, ((0,3), (1,2)): 2}
+quantum_compute_modes = ("table", "batched", "circuit")
+# "exact" checks the ideal final state, "shots" samples it and is meant for noisy backends
+verification_methods = ("exact", "shots")
+verification_shots = 256
+zero_state_tolerance = 1e-9
+
+logger = logging.getLogger(__name__)
+
 class Pairing:
     def __init__(self, pair1, pair2):
         self.bit0 = pair1[0]
@@ -38,43 +50,47 @@ def psi_minus(bit0, bit1, qc):
     qc.cx(bit0, bit1)
 
 def circuit00(pairs):
+    from qiskit.circuit import QuantumRegister, ClassicalRegister, QuantumCircuit
     q = QuantumRegister(qbits)
     b = ClassicalRegister(qbits)
     qc = QuantumCircuit(q, b)
 
     phi_plus(q[pairs.bit0], q[pairs.bit1], qc)
     phi_minus(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Alice chose group 00")
+    logger.debug("Alice chose group 00")
     return qc, q
 
 def circuit01(pairs):
+    from qiskit.circuit import QuantumRegister, ClassicalRegister, QuantumCircuit
     q = QuantumRegister(qbits)
     b = ClassicalRegister(qbits)
     qc = QuantumCircuit(q, b)
 
     phi_minus(q[pairs.bit0], q[pairs.bit1], qc)
     phi_plus(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Alice chose group 01")
+    logger.debug("Alice chose group 01")
     return qc, q
 
 def circuit10(pairs):
+    from qiskit.circuit import QuantumRegister, ClassicalRegister, QuantumCircuit
     q = QuantumRegister(qbits)
     b = ClassicalRegister(qbits)
     qc = QuantumCircuit(q, b)
 
     psi_plus(q[pairs.bit0], q[pairs.bit1], qc)
     psi_minus(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Alice chose group 10")
+    logger.debug("Alice chose group 10")
     return qc, q
 
 def circuit11(pairs):
+    from qiskit.circuit import QuantumRegister, ClassicalRegister, QuantumCircuit
     q = QuantumRegister(qbits)
     b = ClassicalRegister(qbits)
     qc = QuantumCircuit(q, b)
 
     psi_minus(q[pairs.bit0], q[pairs.bit1], qc)
     psi_plus(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Alice chose group 11")
+    logger.debug("Alice chose group 11")
     return qc, q
 
 ################################
@@ -107,32 +123,30 @@ def psi_minus_reverse(bit0, bit1, qc):
 def reverse_circuit00(pairs, q, qc):
     phi_plus_reverse(q[pairs.bit0], q[pairs.bit1], qc)
     phi_minus_reverse(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Bob chose group 00")
+    logger.debug("Bob chose group 00")
 
 def reverse_circuit01(pairs, q, qc):
     phi_minus_reverse(q[pairs.bit0], q[pairs.bit1], qc)
     phi_plus_reverse(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Bob chose group 01")
-    # print(qc)
+    logger.debug("Bob chose group 01")
 
 def reverse_circuit10(pairs, q, qc):
     psi_plus_reverse(q[pairs.bit0], q[pairs.bit1], qc)
     psi_minus_reverse(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Bob chose group 10")
-    # print(qc)
+    logger.debug("Bob chose group 10")
 
 def reverse_circuit11(pairs, q, qc):
     psi_minus_reverse(q[pairs.bit0], q[pairs.bit1], qc)
     psi_plus_reverse(q[pairs.bit2], q[pairs.bit3], qc)
-    print("Bob chose group 11")
-    # print(qc)
+    logger.debug("Bob chose group 11")
 
-def generate_random_pairings(length):
-    all_pairings = [[[0,1], [2,3]], [[0,2], [1,3]], [[0,3], [1,2]]]
-    return [random.choice(all_pairings) for _ in range(length)]
+def generate_random_pairings(length, rng=None):
+    rng = rng or get_rng()
+    return [all_pairings[i] for i in rng.integers(len(all_pairings), size=length)]
 
-def generate_random_groupings(length):
-    return [random.randint(0,3) for _ in range(length)]
+def generate_random_groupings(length, rng=None):
+    rng = rng or get_rng()
+    return rng.integers(4, size=length).tolist()
 
 
 def get_correct_measurements(alice_json, bob_json):
@@ -154,33 +168,135 @@ def get_correct_measurements(alice_json, bob_json):
         bob_correct["groupings"].append(bob_initial_groupings[i])
 
     return alice_correct, bob_correct
-def verify_circuit(qc):
-    qc.measure_all()
-    backend = Aer.get_backend('qasm_simulator')
-    job = execute(qc, backend, shots=256)
-    #qc.measure_all()
-    #job = execute(qc, backend=QI_BACKEND, shots=256)
-    result = job.result()
-    histogram = result.get_counts(qc)
-    print(histogram)
-
+def is_all_zeros(histogram):
     # If Bob guessed Alice's qubit-pairs and Bell states correctly,
     # the final state of all qubits should be 0s
-    state_list = list(histogram.keys())
-    print(state_list)
-    if (len(state_list) == 1 and state_list[0] == "0000 0000"):
+    return len(histogram) == 1 and set(next(iter(histogram))) <= {"0", " "}
+
+def is_zero_state(qc):
+    # The circuits are Clifford and ideal, so a correct guess leaves exactly |0000>
+    from qiskit.quantum_info import Statevector
+    state = Statevector(qc.remove_final_measurements(inplace=False))
+    return abs(state.data[0]) ** 2 > 1 - zero_state_tolerance
+
+def verify_circuit(qc, method="exact", seed_simulator=None):
+    qc.measure_all()
+    if method == "exact":
+        return 1 if is_zero_state(qc) else 0
+
+    # Arbitrary circuits are run as built on the shared simulator, without a template
+    result = run_circuits(qc, shots=verification_shots, seed_simulator=seed_simulator)
+    histogram = result.get_counts(0)
+    logger.debug("Verification histogram: %s", histogram)
+
+    if is_all_zeros(histogram):
         return 1
     return 0
 
+def verify_circuits(circuits, shots=verification_shots, method="exact", seed_simulator=None):
+    # Circuits are already measured and transpiled. With "shots" the whole round is
+    # submitted as one Aer job and every histogram is read from the single Result.
+    if not circuits:
+        return []
+    if method == "exact":
+        with timed("simulate"):
+            return [1 if is_zero_state(qc) else 0 for qc in circuits]
+    result = run_circuits(circuits, shots=shots, seed_simulator=seed_simulator)
+    with timed("decode"):
+        return [1 if is_all_zeros(result.get_counts(i)) else 0 for i in range(len(circuits))]
+
 entangling_circuit_map = {0: circuit00, 1: circuit01, 2: circuit10, 3: circuit11}
 reversal_circuit_map = {0: reverse_circuit00, 1: reverse_circuit01, 2: reverse_circuit10, 3: reverse_circuit11}
-def quantum_compute(alice_data, bob_data):
+
+def build_bs_circuit(alice_pairing, alice_gc, bob_pairing, bob_gc):
+    qc, q = entangling_circuit_map[alice_gc](Pairing(alice_pairing[0], alice_pairing[1]))
+    reversal_circuit_map[bob_gc](Pairing(bob_pairing[0], bob_pairing[1]), q, qc)
+    qc.measure_all()
+    return qc
+
+def get_bs_circuit(alice_pairing, alice_gc, bob_pairing, bob_gc):
+    # Transpiled template for one (pairing, grouping) combination of Alice and Bob
+    key = ("bs", pairing_index[(tuple(alice_pairing[0]), tuple(alice_pairing[1]))], int(alice_gc),
+           pairing_index[(tuple(bob_pairing[0]), tuple(bob_pairing[1]))], int(bob_gc))
+    return get_template(key, lambda: build_bs_circuit(alice_pairing, alice_gc, bob_pairing, bob_gc))
+
+##########################################
+# Precomputed (Alice, Bob) outcome table #
+##########################################
+# There are only 3 pairings x 4 groupings per party, so every (Alice, Bob)
+# combination is simulated once and afterwards looked up by index.
+_outcome_table = None
+
+def build_outcome_table(verification="exact"):
+    # All 144 combinations are verified in one pass
+    combinations = [(alice_p, alice_gc, bob_p, bob_gc)
+                    for alice_p in range(len(all_pairings)) for alice_gc in range(4)
+                    for bob_p in range(len(all_pairings)) for bob_gc in range(4)]
+    circuits = [get_bs_circuit(all_pairings[alice_p], alice_gc, all_pairings[bob_p], bob_gc)
+                for alice_p, alice_gc, bob_p, bob_gc in combinations]
+    table = np.zeros((len(all_pairings), 4, len(all_pairings), 4), dtype=bool)
+    for combination, correct in zip(combinations, verify_circuits(circuits, method=verification)):
+        table[combination] = correct
+    return table
+
+def get_outcome_table():
+    global _outcome_table
+    if _outcome_table is None:
+        _outcome_table = build_outcome_table()
+    return _outcome_table
+
+def set_outcome_table(table):
+    global _outcome_table
+    _outcome_table = table
+
+def pairings_to_indices(pairings):
+    # Every pairing starts with qubit 0, so its partner identifies the pairing
+    pairings = np.asarray(pairings, dtype=np.intp).reshape(-1, 4)
+    indices = pairings[:, 1] - 1
+    if not (np.all((indices >= 0) & (indices < len(all_pairings)))
+            and np.array_equal(all_pairings_array[indices].reshape(-1, 4), pairings)):
+        raise ValueError("Unknown qubit pairing")
+    return indices
+
+def lookup_correct_guesses(alice_qpairs, alice_groupcodes, bob_qpairs, bob_groupcodes):
+    table = get_outcome_table()
+    count("qkd_outcome_table_lookups_total", len(alice_groupcodes))
+    correct = table[pairings_to_indices(alice_qpairs), np.asarray(alice_groupcodes, dtype=np.intp),
+                    pairings_to_indices(bob_qpairs), np.asarray(bob_groupcodes, dtype=np.intp)]
+    return np.flatnonzero(correct).tolist()
+
+def quantum_compute(alice_data, bob_data, mode="table", verification=None, seed_simulator=None):
     alice_qpairs = alice_data["pairings"]
     alice_groupcodes = alice_data["groupings"]
 
     bob_qpairs = bob_data["pairings"]
     bob_groupcodes = bob_data["groupings"]
 
+    if mode not in quantum_compute_modes:
+        raise ValueError(f"Unknown quantum_compute mode: {mode}")
+    # Batched rounds are one Aer job by default, the other modes check the statevector
+    if verification is None:
+        verification = "shots" if mode == "batched" else "exact"
+    if verification not in verification_methods:
+        raise ValueError(f"Unknown verification method: {verification}")
+
+    if mode == "table":
+        correct_guesses = lookup_correct_guesses(alice_qpairs, alice_groupcodes, bob_qpairs, bob_groupcodes)
+        alice_data["correct_measurements"] = correct_guesses
+        bob_data["correct_measurements"] = correct_guesses
+        return alice_data, bob_data
+
+    if mode == "batched":
+        circuits = [get_bs_circuit(alice_qpairs[i], alice_groupcodes[i], bob_qpairs[i], bob_groupcodes[i])
+                    for i in range(len(alice_qpairs))]
+        correct_guesses = [i for i, correct in enumerate(verify_circuits(circuits, method=verification,
+                                                                           seed_simulator=seed_simulator)) if correct]
+        alice_data["correct_measurements"] = correct_guesses
+        bob_data["correct_measurements"] = correct_guesses
+        return alice_data, bob_data
+
+    # "circuit" mode: simulate every pairing on its own, used to verify the table
+
     # Keeps track of the indices in Bob's list that were correct guesses
     correct_guesses = []
 
@@ -201,24 +317,16 @@ def quantum_compute(alice_data, bob_data):
         reversal_circuit_map[bob_gc](qpairs, q, qc)
 
         # Add the index to the list of correct guesses to return to the users
-        if (verify_circuit(qc)):
+        if (verify_circuit(qc, method=verification, seed_simulator=seed_simulator)):
             correct_guesses.append(i)
-            print("Bob's guess was correct")
+            logger.debug("Bob's guess was correct")
 
     alice_data["correct_measurements"] = correct_guesses
     bob_data["correct_measurements"] = correct_guesses
 
     return alice_data, bob_data
 
+grouping_codes = {0: "00", 1: "01", 2: "10", 3: "11"}
+
 def generate_code(groupings):
-    code = ""
-    for i in groupings:
-        if i == 0:
-            code += "00"
-        if i == 1:
-            code += "01"
-        if i == 2:
-            code += "10"
-        if i == 3:
-            code += "11"
-    return code
\ No newline at end of file
+    return "".join(grouping_codes[i] for i in groupings if i in grouping_codes)
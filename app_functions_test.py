@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from app_functions import (all_pairings, build_outcome_table, generate_random_groupings,
+                           generate_random_pairings, get_outcome_table, is_all_zeros, quantum_compute)
+from metrics import collect_metrics
+
+
+def test_outcome_table_matches_matching_guesses():
+    table = get_outcome_table()
+    assert table.shape == (3, 4, 3, 4)
+    for alice_p in range(len(all_pairings)):
+        for alice_gc in range(4):
+            for bob_p in range(len(all_pairings)):
+                for bob_gc in range(4):
+                    expected = alice_p == bob_p and alice_gc == bob_gc
+                    assert table[alice_p, alice_gc, bob_p, bob_gc] == expected
+
+
+def test_table_mode_matches_circuit_mode():
+    rng = np.random.default_rng(7)
+    alice_json = {"pairings": generate_random_pairings(20, rng=rng),
+                  "groupings": generate_random_groupings(20, rng=rng)}
+    bob_json = {"pairings": list(alice_json["pairings"]), "groupings": list(alice_json["groupings"])}
+    # Make half of Bob's guesses wrong
+    for i in range(0, 20, 2):
+        bob_json["groupings"][i] = (bob_json["groupings"][i] + 1) % 4
+
+    table_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="table")
+    circuit_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="circuit")
+    assert table_alice["correct_measurements"] == circuit_alice["correct_measurements"]
+    assert table_alice["correct_measurements"] == list(range(1, 20, 2))
+
+
+def test_batched_mode_matches_table_mode():
+    rng = np.random.default_rng(11)
+    alice_json = {"pairings": generate_random_pairings(40, rng=rng),
+                  "groupings": generate_random_groupings(40, rng=rng)}
+    bob_json = {"pairings": generate_random_pairings(40, rng=rng),
+                "groupings": generate_random_groupings(40, rng=rng)}
+
+    table_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="table")
+    collect_metrics()
+    batched_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="batched")
+    assert batched_alice["correct_measurements"] == table_alice["correct_measurements"]
+    # The whole round is one Aer job
+    assert collect_metrics()[1][("qkd_simulator_jobs_total", ())] == 1
+
+
+def test_shot_verification_matches_exact():
+    assert np.array_equal(build_outcome_table(verification="shots"), build_outcome_table(verification="exact"))
+
+    rng = np.random.default_rng(3)
+    alice_json = {"pairings": generate_random_pairings(12, rng=rng),
+                  "groupings": generate_random_groupings(12, rng=rng)}
+    bob_json = {"pairings": generate_random_pairings(12, rng=rng),
+                "groupings": generate_random_groupings(12, rng=rng)}
+    exact_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="circuit")
+    shots_alice, _ = quantum_compute(dict(alice_json), dict(bob_json), mode="circuit", verification="shots")
+    assert exact_alice["correct_measurements"] == shots_alice["correct_measurements"]
+
+
+def test_is_all_zeros():
+    assert is_all_zeros({"0000 0000": 256})
+    assert is_all_zeros({"0000": 256})
+    assert not is_all_zeros({"0000 0000": 128, "0011 0000": 128})
+    assert not is_all_zeros({"0100 0000": 256})
+
+
+def test_unknown_verification_method():
+    with pytest.raises(ValueError):
+        quantum_compute({"pairings": [], "groupings": []}, {"pairings": [], "groupings": []},
+                        verification="tomography")
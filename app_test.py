@@ -0,0 +1,31 @@
+import matplotlib.pyplot as plt
+from streamlit.testing.v1 import AppTest
+
+
+def test_pages_show_cached_diagrams_without_open_figures():
+    at = AppTest.from_file("app.py", default_timeout=120).run()
+    assert not at.exception
+    assert len(at.get("imgs")) == 4
+    for page, images in (("Entangled Bell States", 4), ("Final Circuit", 1), ("Bell States", 4)):
+        at.radio[0].set_value(page).run()
+        assert not at.exception
+        assert len(at.get("imgs")) == images
+    assert plt.get_fignums() == []
+
+
+def test_rendered_diagrams_are_png_bytes():
+    from app import build_final_circuit, render_circuit_png
+    assert render_circuit_png(build_final_circuit()).startswith(b"\x89PNG")
+    assert plt.get_fignums() == []
+
+
+def test_shared_key_page_runs_a_key_job():
+    at = AppTest.from_file("app.py", default_timeout=300).run()
+    at.radio[0].set_value("Generate Shared Key").run()
+    at.selectbox[0].set_value("BB84")
+    at.number_input[0].set_value(5000)
+    at.button[0].click().run()
+    assert not at.exception
+    assert "5000 of 5000 bits" in at.markdown[-2].value
+    assert at.markdown[-1].value == "Mismatching bits: 0"
+    assert len(at.code) == 2
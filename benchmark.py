@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Throughput and latency of key generation per case and key length. Results can be saved as a
+# JSON baseline and later runs compared against it.
+benchmark_key_lengths = (256, 1024, 4096)
+benchmark_repeats = 5
+benchmark_seed = 1234
+benchmark_threshold = 0.25
+# Cold-start import time of the modules the key service and its pool workers load, each
+# measured in a fresh interpreter, and which heavy packages the import pulled in
+import_modules = ("generate_key", "worker_pool", "generate_bs_key", "generate_bb84_key", "generate_e91_key")
+heavy_modules = ("qiskit", "qiskit_aer", "matplotlib", "PIL")
+
+
+def quantum_compute_case(mode):
+    def run(n):
+        from app_functions import generate_random_groupings, generate_random_pairings, quantum_compute
+        # n pairings, the key bits are the groupings of the correct guesses
+        alice_json = {"pairings": generate_random_pairings(n), "groupings": generate_random_groupings(n)}
+        bob_json = {"pairings": generate_random_pairings(n), "groupings": generate_random_groupings(n)}
+        alice_json, _ = quantum_compute(alice_json, bob_json, mode=mode)
+        return 2 * len(alice_json["correct_measurements"])
+    return run
+
+
+def protocol_case(protocol, **options):
+    def run(n):
+        from generate_bb84_key import bb84_qkd_protocol
+        from generate_bs_key import bs_qkd_protocol
+        from generate_e91_key import e91_qkd_protocol
+        function = {"BS": bs_qkd_protocol, "BB84": bb84_qkd_protocol, "E91": e91_qkd_protocol}[protocol]
+        return len(function(n, **options)[0])
+    return run
+
+
+_client = None
+
+
+def api_case(route):
+    def run(n):
+        # Requests run on the app's worker pool, the reservoirs are not started
+        global _client
+        if _client is None:
+            from fastapi.testclient import TestClient
+            from generate_key import app
+            _client = TestClient(app)
+        response = _client.get(f"{route}/{n}")
+        response.raise_for_status()
+        return len(response.json()["alice_key"])
+    return run
+
+
+benchmark_cases = {
+    "quantum_compute_table": quantum_compute_case("table"),
+    "quantum_compute_batched": quantum_compute_case("batched"),
+    "quantum_compute_circuit": quantum_compute_case("circuit"),
+    "bs_qkd_protocol_aer": protocol_case("BS", backend="aer"),
+    "bs_qkd_protocol_analytic": protocol_case("BS", backend="analytic"),
+    "bb84_qkd_protocol_aer": protocol_case("BB84", backend="aer"),
+    "bb84_qkd_protocol_analytic": protocol_case("BB84", backend="analytic"),
+    "e91_qkd_protocol_aer": protocol_case("E91", backend="aer"),
+    "e91_qkd_protocol_analytic": protocol_case("E91", backend="analytic"),
+    "api_bs_key": api_case("/bs_key"),
+    "api_bb84_key": api_case("/bb84_key"),
+    "api_e91_key": api_case("/e91_key"),
+}
+
+
+def seed_everything(seed):
+    from randomness import set_rng
+    set_rng(np.random.default_rng(seed))
+
+
+def measure(run, n, repeats, seed):
+    from simulation import job_count
+
+    # One warm-up run fills the circuit caches, the BS table and the worker pool
+    seed_everything(seed)
+    run(n)
+
+    latencies, bits = [], 0
+    for i in range(repeats):
+        seed_everything(seed + i)
+        start = time.perf_counter()
+        bits += run(n)
+        latencies.append(time.perf_counter() - start)
+
+    # Peak memory and simulator jobs come from a separate run, tracemalloc slows the timed ones down
+    seed_everything(seed)
+    jobs = job_count()
+    tracemalloc.start()
+    run(n)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "bits_per_second": bits / sum(latencies),
+        "p50_latency": float(np.percentile(latencies, 50)),
+        "p99_latency": float(np.percentile(latencies, 99)),
+        "peak_memory": peak_memory,
+        # Jobs submitted by worker processes (API cases) are not visible here
+        "simulator_jobs": job_count() - jobs,
+    }
+
+
+def measure_import(module, repeats):
+    code = (f"import sys, time; start = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - start, *[m for m in {heavy_modules!r} if m in sys.modules])")
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        times.append(float(output[0]))
+    return {"p50_seconds": float(np.percentile(times, 50)), "max_seconds": max(times), "heavy_modules": output[1:]}
+
+
+def run_benchmarks(cases=None, key_lengths=benchmark_key_lengths, repeats=benchmark_repeats, seed=benchmark_seed,
+                   imports=()):
+    results = {}
+    for name in benchmark_cases if cases is None else cases:
+        results[name] = {str(n): measure(benchmark_cases[name], n, repeats, seed) for n in key_lengths}
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "repeats": repeats,
+                 "seed": seed, "key_lengths": list(key_lengths), "date": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    if imports:
+        report["imports"] = {module: measure_import(module, repeats) for module in imports}
+    return report
+
+
+def compare(baseline, current, threshold=benchmark_threshold):
+    # Regressions are cases slower than the baseline by more than threshold,
+    # either in throughput or in p99 latency
+    regressions = []
+    for name, lengths in current["results"].items():
+        for n, result in lengths.items():
+            base = baseline["results"].get(name, {}).get(n)
+            if base is None:
+                continue
+            if result["bits_per_second"] < base["bits_per_second"] * (1 - threshold):
+                regressions.append((name, n, "bits_per_second", base["bits_per_second"], result["bits_per_second"]))
+            if result["p99_latency"] > base["p99_latency"] * (1 + threshold):
+                regressions.append((name, n, "p99_latency", base["p99_latency"], result["p99_latency"]))
+    for module, result in current.get("imports", {}).items():
+        base = baseline.get("imports", {}).get(module)
+        if base is not None and result["p50_seconds"] > base["p50_seconds"] * (1 + threshold):
+            regressions.append((module, "import", "p50_seconds", base["p50_seconds"], result["p50_seconds"]))
+    return regressions
+
+
+def print_results(report):
+    print(f"{'case':<28}{'bits':>7}{'bits/s':>14}{'p50 ms':>10}{'p99 ms':>10}{'peak KiB':>11}{'jobs':>6}")
+    for name, lengths in report["results"].items():
+        for n, result in lengths.items():
+            print(f"{name:<28}{n:>7}{result['bits_per_second']:>14.0f}{result['p50_latency'] * 1e3:>10.2f}"
+                  f"{result['p99_latency'] * 1e3:>10.2f}{result['peak_memory'] / 1024:>11.0f}"
+                  f"{result['simulator_jobs']:>6}")
+    if "imports" in report:
+        print(f"{'import':<28}{'p50 ms':>10}{'max ms':>10}  heavy modules")
+        for module, result in report["imports"].items():
+            print(f"{module:<28}{result['p50_seconds'] * 1e3:>10.1f}{result['max_seconds'] * 1e3:>10.1f}  "
+                  f"{' '.join(result['heavy_modules']) or '-'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark QKD key generation")
+    parser.add_argument("--cases", nargs="*", choices=sorted(benchmark_cases), default=None,
+                        help="key generation cases, all by default, none with an empty list")
+    parser.add_argument("--key-lengths", nargs="+", type=int, default=benchmark_key_lengths)
+    parser.add_argument("--repeats", type=int, default=benchmark_repeats)
+    parser.add_argument("--seed", type=int, default=benchmark_seed)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=benchmark_threshold)
+    parser.add_argument("--imports", nargs="*", choices=import_modules, default=None,
+                        help="measure cold-start import time, of every service module without arguments")
+    args = parser.parse_args(argv)
+
+    imports = () if args.imports is None else args.imports or import_modules
+    report = run_benchmarks(args.cases, args.key_lengths, args.repeats, args.seed, imports)
+    print_results(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        for name, n, metric, before, after in regressions:
+            print(f"REGRESSION {name} {n} bits: {metric} {before:.4g} -> {after:.4g}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
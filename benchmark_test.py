@@ -0,0 +1,29 @@
+from benchmark import compare, run_benchmarks
+
+
+def test_benchmark_reports_every_metric():
+    report = run_benchmarks(["bb84_qkd_protocol_aer", "e91_qkd_protocol_analytic"], key_lengths=(64,), repeats=2)
+    for name in ("bb84_qkd_protocol_aer", "e91_qkd_protocol_analytic"):
+        result = report["results"][name]["64"]
+        assert result["bits_per_second"] > 0
+        assert 0 < result["p50_latency"] <= result["p99_latency"]
+        assert result["peak_memory"] > 0
+    assert report["results"]["bb84_qkd_protocol_aer"]["64"]["simulator_jobs"] >= 1
+    assert report["results"]["e91_qkd_protocol_analytic"]["64"]["simulator_jobs"] == 0
+
+
+def test_compare_flags_regressions_beyond_threshold():
+    def report(bits_per_second, p99_latency):
+        return {"results": {"case": {"64": {"bits_per_second": bits_per_second, "p99_latency": p99_latency}}}}
+
+    assert compare(report(1000, 0.010), report(900, 0.011), threshold=0.25) == []
+    regressions = compare(report(1000, 0.010), report(500, 0.020), threshold=0.25)
+    assert [metric for _, _, metric, _, _ in regressions] == ["bits_per_second", "p99_latency"]
+
+
+def test_service_imports_skip_qiskit_and_plotting():
+    report = run_benchmarks(cases=[], key_lengths=(), repeats=1, imports=["generate_key", "worker_pool"])
+    assert report["results"] == {}
+    for module in ("generate_key", "worker_pool"):
+        assert report["imports"][module]["p50_seconds"] > 0
+        assert report["imports"][module]["heavy_modules"] == []
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+
+from analytic_backend import StatevectorCircuit, e91_alice_measurements, e91_bob_measurements
+from metrics import timed
+from randomness import get_rng
+
+# Channel characterization runs in chunks so millions of qubits never sit in memory at once
+channel_chunk_size = int(os.environ.get("QKD_CHANNEL_CHUNK_SIZE", 1 << 20))
+channel_max_qubits = int(os.environ.get("QKD_CHANNEL_MAX_QUBITS", 1 << 26))
+# Aer noise models stay as the slower reference
+channel_max_aer_qubits = int(os.environ.get("QKD_CHANNEL_MAX_AER_QUBITS", 1 << 20))
+channel_parameters = ("depolarizing", "bit_flip", "loss", "interception")
+
+# Interception codes: 0 is an untouched qubit, 1 + basis is the basis Eve measured in
+no_interception = 0
+
+inverse_gates = {"h": "h", "s": "sdg", "sdg": "s", "t": "tdg", "tdg": "t"}
+
+class ChannelModel:
+    # depolarizing and bit_flip are error probabilities per qubit (per pair for E91
+    # depolarizing), loss is the probability a photon never reaches the detector and
+    # interception the fraction of qubits an intercept-resend eavesdropper measures and resends
+    def __init__(self, depolarizing=0.0, bit_flip=0.0, loss=0.0, interception=0.0):
+        for name, value in zip(channel_parameters, (depolarizing, bit_flip, loss, interception)):
+            if not 0 <= value <= 1:
+                raise ValueError(f"{name} must be between 0 and 1")
+        self.depolarizing = depolarizing
+        self.bit_flip = bit_flip
+        self.loss = loss
+        self.interception = interception
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in channel_parameters}
+
+    def aer_errors(self, qubits):
+        # Aer errors for the reference circuits: depolarizing on all qubits, bit flip on Bob's (last) qubit
+        from qiskit_aer.noise import depolarizing_error, pauli_error
+        errors = []
+        if self.bit_flip:
+            errors.append((pauli_error([("X", self.bit_flip), ("I", 1 - self.bit_flip)]), [qubits[-1]]))
+        if self.depolarizing:
+            errors.append((depolarizing_error(self.depolarizing, len(qubits)), list(qubits)))
+        return errors
+
+    def __repr__(self):
+        return "ChannelModel(" + ", ".join(f"{name}={value}" for name, value in self.as_dict().items()) + ")"
+
+
+def check_channel_delivers(channel):
+    # Key generation runs rounds until enough bits are sifted, which never happens when every photon is lost
+    if channel is not None and channel.loss == 1:
+        raise ValueError("No key can be sifted through a channel with loss 1")
+
+
+def sample_detections(n, channel, photons=1, rng=None):
+    # A qubit (or an E91 pair, photons=2) is detected when none of its photons is lost
+    rng = rng or get_rng()
+    return rng.random(n) >= 1 - (1 - channel.loss) ** photons
+
+
+def sample_interceptions(n, channel, bases, rng=None):
+    # Interception code per qubit, Eve picks one of `bases` measurement bases at random
+    rng = rng or get_rng()
+    intercepted = rng.random(n) < channel.interception
+    return np.where(intercepted, 1 + rng.integers(bases, size=n), no_interception).astype(np.uint8)
+
+
+########
+# BB84 #
+########
+@timed("simulate")
+def sample_bb84_channel(alice_bits, alice_basis, bob_basis, interceptions, channel, rng=None):
+    # Bob's results when the qubits pass Eve, then a bit-flip and a depolarizing channel
+    rng = rng or get_rng()
+    n = len(alice_bits)
+    eve_basis = interceptions.astype(np.int64) - 1
+    intercepted = interceptions != no_interception
+
+    # Eve reads Alice's bit in a matching basis and a fair coin otherwise, then resends in her basis
+    eve_bits = np.where(eve_basis == alice_basis, alice_bits, rng.integers(2, size=n))
+    sent_bits = np.where(intercepted, eve_bits, alice_bits)
+    sent_basis = np.where(intercepted, eve_basis, alice_basis)
+
+    bob_results = np.where(bob_basis == sent_basis, sent_bits, rng.integers(2, size=n))
+    # X leaves diagonal-basis outcomes unchanged
+    bob_results ^= (rng.random(n) < channel.bit_flip) & (bob_basis == 0)
+    depolarized = rng.random(n) < channel.depolarizing
+    bob_results = np.where(depolarized, rng.integers(2, size=n), bob_results)
+    return bob_results.astype(np.uint8)
+
+
+#######
+# E91 #
+#######
+def e91_component_table(eve_basis, flipped):
+    # Like analytic_backend.e91_probabilities, with Eve measuring Bob's qubit along one of
+    # Bob's directions and resending it, and optionally an X error on Bob's qubit
+    table = np.zeros((3, 3, 4))
+    eve_outcomes = (None,) if eve_basis is None else (0, 1)
+    for a, alice_gates in enumerate(e91_alice_measurements):
+        for b, bob_gates in enumerate(e91_bob_measurements):
+            for eve_outcome in eve_outcomes:
+                sv = StatevectorCircuit(2)
+                sv.x(0)
+                sv.x(1)
+                sv.h(0)
+                sv.cx(0, 1)
+                weight = 1.0
+                if eve_outcome is not None:
+                    for gate in e91_bob_measurements[eve_basis]:
+                        getattr(sv, gate)(1)
+                    weight = sv.project(1, eve_outcome)
+                    for gate in reversed(e91_bob_measurements[eve_basis]):
+                        getattr(sv, inverse_gates[gate])(1)
+                if flipped:
+                    sv.x(1)
+                for gate in alice_gates:
+                    getattr(sv, gate)(0)
+                for gate in bob_gates:
+                    getattr(sv, gate)(1)
+                table[a, b] += weight * sv.probabilities()
+    return table
+
+
+def e91_channel_tables(channel):
+    # Outcome probabilities per interception code, shape (4, 3, 3, 4). Bit flips and
+    # depolarizing are mixed in exactly, only the interception is sampled per singlet.
+    tables = np.zeros((4, 3, 3, 4))
+    for code, eve_basis in enumerate((None, 0, 1, 2)):
+        table = ((1 - channel.bit_flip) * e91_component_table(eve_basis, False)
+                 + channel.bit_flip * e91_component_table(eve_basis, True))
+        tables[code] = (1 - channel.depolarizing) * table + channel.depolarizing / 4
+    return tables
+
+
+@timed("simulate")
+def sample_e91_channel(alice_choices, bob_choices, interceptions, channel, rng=None):
+    # Vectorized sampling of every singlet's outcome under the channel, outcome = 2 * cr[1] + cr[0]
+    rng = rng or get_rng()
+    cumulative = np.cumsum(e91_channel_tables(channel), axis=3)
+    cdf = cumulative[interceptions, np.asarray(alice_choices) - 1, np.asarray(bob_choices) - 1]
+    u = rng.random(len(cdf))
+    return np.minimum((u[:, None] >= cdf).sum(axis=1), 3).astype(np.uint8)
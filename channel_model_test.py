@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from channel_model import ChannelModel, e91_channel_tables
+from generate_bb84_key import bb84_channel_statistics
+from generate_e91_key import e91_channel_statistics
+
+
+def test_channel_parameters_are_probabilities():
+    with pytest.raises(ValueError):
+        ChannelModel(loss=1.5)
+
+
+def test_protocols_reject_a_channel_that_loses_every_photon():
+    from generate_bb84_key import bb84_qkd_protocol
+    from generate_e91_key import e91_qkd_protocol
+    for protocol in (bb84_qkd_protocol, e91_qkd_protocol):
+        with pytest.raises(ValueError):
+            protocol(64, backend="analytic", channel=ChannelModel(loss=1.0))
+
+
+def test_e91_channel_tables_are_distributions():
+    tables = e91_channel_tables(ChannelModel(depolarizing=0.1, bit_flip=0.2, interception=0.5))
+    assert np.allclose(tables.sum(axis=3), 1)
+
+
+def test_bb84_intercept_resend_gives_quarter_qber():
+    statistics = bb84_channel_statistics(2 * 10**6, ChannelModel(interception=1.0, loss=0.5))
+    assert abs(statistics["qber"] - 0.25) < 0.005
+    assert abs(statistics["key_yield"] - 0.25) < 0.005
+
+
+def test_bb84_aer_reference_matches_analytic():
+    channel = ChannelModel(depolarizing=0.1, bit_flip=0.1)
+    analytic = bb84_channel_statistics(10**6, channel)
+    aer = bb84_channel_statistics(20000, channel, backend="aer")
+    # 5% from the depolarizing channel plus 5% from bit flips in the rectilinear basis
+    assert abs(analytic["qber"] - 0.0975) < 0.003
+    assert abs(aer["qber"] - analytic["qber"]) < 0.015
+
+
+def test_e91_eavesdropper_breaks_chsh_violation():
+    ideal = e91_channel_statistics(10**6, ChannelModel())
+    intercepted = e91_channel_statistics(10**6, ChannelModel(interception=1.0))
+    assert ideal["qber"] == 0 and ideal["chsh"] < -2.7
+    assert abs(intercepted["chsh"]) < 2
+    assert intercepted["qber"] > 0.15
+
+
+def test_e91_aer_reference_matches_analytic():
+    channel = ChannelModel(depolarizing=0.2, loss=0.3)
+    analytic = e91_channel_statistics(10**6, channel)
+    aer = e91_channel_statistics(30000, channel, backend="aer")
+    assert abs(analytic["qber"] - 0.1) < 0.005
+    assert abs(aer["qber"] - analytic["qber"]) < 0.02
+    assert abs(aer["chsh"] - analytic["chsh"]) < 0.15
@@ -1,78 +1,159 @@
-from fastapi import FastAPI, HTTPException
 import numpy as np
-from qiskit import QuantumCircuit, Aer, execute
-import time
+import math
 
-app = FastAPI()
+from analytic_backend import sample_bb84
+from channel_model import (channel_chunk_size, check_channel_delivers, no_interception, sample_bb84_channel,
+                           sample_detections, sample_interceptions)
+from metrics import timed
+from qkd_key import QKDKey
+from randomness import get_rng, simulator_seed
+from simulation import get_template, prepare_circuit, run_circuits
 
+# Only half of the raw qubits survive sifting, rounds are sized with a small margin
+bb84_sifting_rate = 0.5
+bb84_round_margin = 1.1
 
-def bb84_qkd_protocol(n_bits):
-    qc = QuantumCircuit(n_bits, n_bits)
 
-    # Alice generates random bit string
-    alice_bits = np.random.randint(2, size=n_bits)
+def bb84_qubit_circuit(alice_bit, alice_basis, bob_basis, interception=no_interception, channel=None):
+    # A single BB84 qubit: Alice prepares her bit in her basis, Bob measures in his.
+    # Eve's intercept-resend measurement goes to clbit 1, channel noise is added as Aer errors.
+    from qiskit import QuantumCircuit
+    qc = QuantumCircuit(1, 1 if interception == no_interception else 2)
 
-    # Alice selects random basis for each bit (0 for rectilinear, 1 for diagonal)
-    alice_basis = np.random.randint(2, size=n_bits)
-
-    # Bob randomly chooses basis for each received bit
-    bob_basis = np.random.randint(2, size=n_bits)
-
-    # Encode qubits based on Alice's random bit string and basis
-    for i in range(n_bits):
-        if alice_basis[i] == 0:  # Rectilinear basis
-            if alice_bits[i] == 1:
-                qc.h(i)  # Apply Hadamard gate if bit is 1
-        else:  # Diagonal basis
-            if alice_bits[i] == 1:
-                qc.h(i)  # Apply Hadamard gate if bit is 1
-                qc.s(i)  # Apply S gate for diagonal basis
+    if alice_bit == 1:
+        qc.x(0)
+    if alice_basis == 1:  # Diagonal basis
+        qc.h(0)
 
     qc.barrier()
 
-    # Bob measures received qubits based on his chosen basis
-    for i in range(n_bits):
-        if bob_basis[i] == 0:  # Rectilinear basis
-            qc.measure(i, i)
-        else:  # Diagonal basis
-            qc.sdg(i)
-            qc.h(i)
-            qc.measure(i, i)
-
-    # Simulate the quantum circuit
-    backend = Aer.get_backend('qasm_simulator')
-    job = execute(qc, backend, shots=1)
-    result = job.result()
-    counts = result.get_counts(qc)
-
-    # Alice and Bob discard bits where bases didn't match
-    shared_key = ""
-    for key in counts:
-        index = int(key, 2) % n_bits
-        if alice_basis[index] == bob_basis[index]:
-            shared_key += key
-
-    return shared_key
-
-
-@app.get("/bb84_key/{n_bits}")
-async def generate_shared_key(n_bits: int):
-    if n_bits <= 0:
-        raise HTTPException(status_code=400, detail="Number of bits must be positive")
-
-    st = time.time()
-
-    shared_key = bb84_qkd_protocol(n_bits)
-
-    et = time.time()
-
-    time_taken = et - st
-
-    return {"alice_key": shared_key, "bob_key": shared_key, "time_taken": str(time_taken) }
+    if interception != no_interception:
+        if interception - 1 == 1:
+            qc.h(0)
+        qc.measure(0, 1)
+        if interception - 1 == 1:
+            qc.h(0)
+    if channel is not None:
+        for error, qubits in channel.aer_errors([0]):
+            qc.append(error, qubits)
+
+    if bob_basis == 1:  # Diagonal basis
+        qc.h(0)
+    qc.measure(0, 0)
+    return qc
+
+
+def measure_qubits_aer(alice_bits, alice_basis, bob_basis, interceptions=None, channel=None, seed_simulator=None):
+    # Every qubit is one of 8 (bit, Alice basis, Bob basis) single-qubit experiments, times
+    # 3 interception codes with a channel, so each experiment runs once on the stabilizer
+    # simulator. Aer takes one shot count per job, so all experiments run max(count) shots
+    # and keep the first count. Noisy circuits depend on the channel and are not cached.
+    if interceptions is None:
+        interceptions = np.zeros(len(alice_bits), dtype=np.uint8)
+    experiment = (alice_bits * 4 + alice_basis * 2 + bob_basis) * 3 + interceptions
+    counts = np.bincount(experiment, minlength=24)
+
+    circuits, experiments = [], []
+    for e in np.flatnonzero(counts):
+        bit, a_basis, b_basis, interception = (e // 3) >> 2, ((e // 3) >> 1) & 1, (e // 3) & 1, e % 3
+        if channel is None:
+            circuits.append(get_template(("bb84", e // 3), lambda: bb84_qubit_circuit(bit, a_basis, b_basis),
+                                         method="stabilizer"))
+        else:
+            circuits.append(prepare_circuit(bb84_qubit_circuit(bit, a_basis, b_basis, interception, channel),
+                                            method="stabilizer"))
+        experiments.append(e)
+
+    bob_results = np.zeros(len(alice_bits), dtype=np.uint8)
+    if not circuits:
+        return bob_results
+
+    result = run_circuits(circuits, shots=int(counts.max()), memory=True, method="stabilizer",
+                          seed_simulator=seed_simulator)
+    with timed("decode"):
+        for i, e in enumerate(experiments):
+            # Bob's result is clbit 0, the last character of the memory string
+            memory = np.array([shot[-1] for shot in result.get_memory(i)[:counts[e]]], dtype='U1')
+            bob_results[experiment == e] = memory == '1'
+    return bob_results
+
+
+def simulate_bb84_protocol(n_qubits, backend="analytic", channel=None, rng=None, seed_simulator=None):
+    rng = rng or get_rng()
 
+    # Alice generates random bit string
+    alice_bits = rng.integers(2, size=n_qubits, dtype=np.uint8)
 
+    # Alice selects random basis for each bit (0 for rectilinear, 1 for diagonal)
+    alice_basis = rng.integers(2, size=n_qubits, dtype=np.uint8)
 
-# if __name__ == "__main__":
-#     import uvicorn
-#
-#     uvicorn.run(app, host="127.0.0.1", port=8001)
+    # Bob randomly chooses basis for each received bit
+    bob_basis = rng.integers(2, size=n_qubits, dtype=np.uint8)
+
+    detected = np.ones(n_qubits, dtype=bool)
+    interceptions = np.zeros(n_qubits, dtype=np.uint8)
+    if channel is not None:
+        detected = sample_detections(n_qubits, channel, rng=rng)
+        interceptions = sample_interceptions(n_qubits, channel, bases=2, rng=rng)
+
+    if backend == "analytic":
+        if channel is None:
+            # Matching bases reproduce Alice's bit, mismatched bases give a fair coin
+            bob_results = sample_bb84(alice_bits, alice_basis, bob_basis, rng=rng)
+        else:
+            bob_results = sample_bb84_channel(alice_bits, alice_basis, bob_basis, interceptions, channel, rng=rng)
+    elif backend == "aer":
+        bob_results = measure_qubits_aer(alice_bits, alice_basis, bob_basis, interceptions, channel,
+                                         seed_simulator=simulator_seed(rng, seed_simulator))
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # Alice and Bob discard lost qubits and bits where bases didn't match
+    with timed("sift"):
+        matching = (alice_basis == bob_basis) & detected
+        return alice_bits[matching], bob_results[matching]
+
+
+def bb84_channel_statistics(n_qubits, channel, backend="analytic", rng=None):
+    # QBER and sifted length of n_qubits sent through the channel, simulated chunk by chunk
+    sifted = errors = 0
+    for start in range(0, n_qubits, channel_chunk_size):
+        alice_key, bob_key = simulate_bb84_protocol(min(channel_chunk_size, n_qubits - start),
+                                                    backend=backend, channel=channel, rng=rng)
+        sifted += len(alice_key)
+        errors += int(np.count_nonzero(alice_key != bob_key))
+    return {
+        "protocol": "BB84",
+        "qubits": n_qubits,
+        "sifted_bits": sifted,
+        "errors": errors,
+        "qber": errors / sifted if sifted else None,
+        "key_yield": sifted / n_qubits if n_qubits else None,
+        "channel": channel.as_dict(),
+    }
+
+
+def bb84_qkd_protocol(desired_key_length, backend="analytic", channel=None, return_statistics=False, rng=None,
+                      seed_simulator=None):
+    check_channel_delivers(channel)
+    alice_parts, bob_parts = [], []
+    sifted = qubits = mismatches = rounds = 0
+
+    while sifted < desired_key_length:
+        n_qubits = math.ceil((desired_key_length - sifted) / bb84_sifting_rate * bb84_round_margin)
+        alice_key, bob_key = simulate_bb84_protocol(
+            n_qubits, backend=backend, channel=channel, rng=rng,
+            seed_simulator=None if seed_simulator is None else seed_simulator + rounds)
+        rounds += 1
+        alice_parts.append(QKDKey.from_bits(alice_key))
+        bob_parts.append(QKDKey.from_bits(bob_key))
+        sifted += len(alice_key)
+        qubits += n_qubits
+        mismatches += int(np.count_nonzero(alice_key != bob_key))
+
+    alice_key = QKDKey.concatenate(alice_parts)[:desired_key_length]
+    bob_key = QKDKey.concatenate(bob_parts)[:desired_key_length]
+
+    if return_statistics:
+        return alice_key, bob_key, {"qubits": qubits, "sifted_bits": sifted, "key_mismatches": mismatches}
+    return alice_key, bob_key
@@ -0,0 +1,21 @@
+import numpy as np
+from generate_bb84_key import bb84_qkd_protocol, simulate_bb84_protocol
+
+
+def test_sampler_sifts_about_half_of_a_million_qubits():
+    alice_key, bob_key = simulate_bb84_protocol(10**6)
+    assert np.array_equal(alice_key, bob_key)
+    assert abs(len(alice_key) - 5 * 10**5) < 5000
+
+
+def test_aer_backend_matches_alice_on_matching_bases():
+    alice_key, bob_key = simulate_bb84_protocol(2000, backend="aer")
+    assert np.array_equal(alice_key, bob_key)
+    assert 800 < len(alice_key) < 1200
+
+
+def test_protocol_returns_requested_length():
+    alice_key, bob_key = bb84_qkd_protocol(4096)
+    assert len(alice_key) == len(bob_key) == 4096
+    assert alice_key == bob_key
+    assert set(str(alice_key)) <= {"0", "1"}
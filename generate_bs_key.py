@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+
+from app_functions import quantum_compute, all_pairings, all_pairings_array
+from analytic_backend import sample_bs, groupings_to_bits
+from metrics import timed
+from qkd_key import QKDKey
+from randomness import get_rng, simulator_seed
+
+# Bits per correct guess (one grouping code) and groupings each party picks from
+bits_per_correct_guess = 2
+grouping_choices = 4
+
+# Expected key bits gained per simulated pairing, used to size a round
+expected_bits_per_pairing = bits_per_correct_guess / (len(all_pairings) * grouping_choices)
+round_size_margin = 1.25
+
+def estimate_round_size(remaining_bits):
+    return max(1, math.ceil(remaining_bits / expected_bits_per_pairing * round_size_margin))
+
+def bs_analytic_protocol(desired_key_length, round_size=None, return_statistics=False, rng=None):
+    alice_parts, bob_parts = [], []
+    key_length = pairings = 0
+    while key_length < desired_key_length:
+        n_pairings = round_size or estimate_round_size(desired_key_length - key_length)
+        pairings += n_pairings
+        alice_groupings, bob_groupings = sample_bs(n_pairings, grouping_choices, rng=rng)
+        alice_parts.append(QKDKey.from_bits(groupings_to_bits(alice_groupings)))
+        bob_parts.append(QKDKey.from_bits(groupings_to_bits(bob_groupings)))
+        key_length += len(alice_parts[-1])
+
+    alice_code = QKDKey.concatenate(alice_parts)[:desired_key_length]
+    bob_code = QKDKey.concatenate(bob_parts)[:desired_key_length]
+    if return_statistics:
+        return alice_code, bob_code, {"pairings": pairings, "sifted_bits": key_length}
+    return alice_code, bob_code
+
+def bs_qkd_protocol(desired_key_length, mode="table", round_size=None, backend="aer", return_statistics=False,
+                    rng=None, seed_simulator=None):
+    rng = rng or get_rng()
+    if backend == "analytic":
+        return bs_analytic_protocol(desired_key_length, round_size=round_size, return_statistics=return_statistics,
+                                    rng=rng)
+
+    # With round_size=None each round is sized to cover the remaining key in one batch
+    alice_parts, bob_parts = [], []
+    key_length = pairings = rounds = 0
+    while key_length < desired_key_length:
+        n_pairings = round_size or estimate_round_size(desired_key_length - key_length)
+        pairings += n_pairings
+        # Generate random pairings and groupings for Alice and Bob
+        alice_pairings = all_pairings_array[rng.integers(len(all_pairings), size=n_pairings)]
+        alice_groupings = rng.integers(grouping_choices, size=n_pairings)
+        bob_pairings = all_pairings_array[rng.integers(len(all_pairings), size=n_pairings)]
+        bob_groupings = rng.integers(grouping_choices, size=n_pairings)
+        alice_json = {"pairings": alice_pairings, "groupings": alice_groupings, "correct_measurements": []}
+        bob_json = {"pairings": bob_pairings, "groupings": bob_groupings, "correct_measurements": []}
+        alice_json, bob_json = quantum_compute(alice_json, bob_json, mode=mode,
+                                               seed_simulator=simulator_seed(rng, seed_simulator, rounds))
+        # The key is built from the groupings Bob guessed correctly
+        with timed("sift"):
+            correct = np.asarray(alice_json["correct_measurements"], dtype=np.intp)
+            alice_parts.append(QKDKey.from_bits(groupings_to_bits(alice_groupings[correct])))
+            bob_parts.append(QKDKey.from_bits(groupings_to_bits(bob_groupings[correct])))
+        key_length += len(alice_parts[-1])
+        rounds += 1
+
+    alice_code = QKDKey.concatenate(alice_parts)[:desired_key_length]
+    bob_code = QKDKey.concatenate(bob_parts)[:desired_key_length]
+    if return_statistics:
+        return alice_code, bob_code, {"pairings": pairings, "sifted_bits": key_length}
+    return alice_code, bob_code
@@ -1,16 +1,80 @@
-import qiskit
 # useful additional packages
 import numpy as np
-import random
-# regular expressions module
-import re
+import logging
+import math
+
+from analytic_backend import sample_e91, e91_bob_measurements
+from channel_model import (channel_chunk_size, check_channel_delivers, inverse_gates, no_interception,
+                           sample_detections, sample_e91_channel, sample_interceptions)
+from metrics import timed
+from qkd_key import QKDKey
+from randomness import get_rng, simulator_seed
+from simulation import get_template, prepare_circuit, run_circuits
+
+# "grouped" runs one circuit per (A, B) basis combination with shots=count,
+# "per_singlet" runs one single-shot circuit per singlet
+e91_modes = ("grouped", "per_singlet")
+
+# Only (A2, B1) and (A3, B2) out of the 9 basis combinations yield key bits
+e91_sifting_rate = 2 / 9
+e91_safety_margin = 0.1
+e91_min_round_singlets = 32
+
+logger = logging.getLogger(__name__)
+
+def decode_e91_memory(memory):
+    # Memory strings end with cr[1] cr[0]; returns outcome indices 2 * cr[1] + cr[0]
+    if not memory:
+        return np.zeros(0, dtype=np.uint8)
+    width = len(memory[0])
+    bits = np.frombuffer("".join(memory).encode(), dtype=np.uint8).reshape(-1, width) - ord('0')
+    return (2 * bits[:, -2] + bits[:, -1]).astype(np.uint8)
+
+def run_e91_grouped(aliceMeasurementChoices, bobMeasurementChoices, interceptions=None, channel=None,
+                    seed_simulator=None):
+    # Only 9 distinct (A, B) circuits exist (times 4 interception codes with a channel), so count
+    # how many singlets fall into each and run each circuit once. Aer takes a single shot count
+    # per job, so every circuit runs max(count) shots and keeps the first count memory entries.
+    combination = (np.asarray(aliceMeasurementChoices) - 1) * 3 + (np.asarray(bobMeasurementChoices) - 1)
+    if interceptions is not None:
+        combination = combination * 4 + interceptions
+    counts = np.bincount(combination, minlength=9 if interceptions is None else 36)
+    outcomes = np.zeros(len(combination), dtype=np.uint8)
+
+    combinations = np.flatnonzero(counts)
+    if len(combinations) == 0:
+        return outcomes
+    if channel is None:
+        combination_circuits = get_e91_combination_circuits()
+        circuits = [combination_circuits[c] for c in combinations]
+    else:
+        # Noisy circuits depend on the channel and are not cached
+        circuits = [prepare_circuit(build_e91_channel_circuit(c // 4, c % 4, channel)) for c in combinations]
+
+    result = run_circuits(circuits, shots=int(counts.max()), memory=True, seed_simulator=seed_simulator)
+    with timed("decode"):
+        for i, c in enumerate(combinations):
+            outcomes[combination == c] = decode_e91_memory(result.get_memory(i)[:counts[c]])
+
+    return outcomes
+
+def run_e91_circuits(aliceMeasurementChoices, bobMeasurementChoices, seed_simulator=None):
+    # One single-shot circuit per singlet. Every singlet reuses the transpiled template
+    # of its (A, B) combination instead of composing and transpiling a new circuit.
+    combination = (np.asarray(aliceMeasurementChoices) - 1) * 3 + (np.asarray(bobMeasurementChoices) - 1)
+    if len(combination) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    combination_circuits = get_e91_combination_circuits()
+    circuits = [combination_circuits[c] for c in combination]
+
+    result = run_circuits(circuits, shots=1, memory=True, seed_simulator=seed_simulator)
+    with timed("decode"):
+        return decode_e91_memory([result.get_memory(i)[0] for i in range(len(circuits))])
+
+def build_e91_circuits():
+    # Qiskit is only loaded once an Aer run needs the circuits
+    from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister
 
-# importing the QISKit
-from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister, execute, Aer
-
-# import basic plot tools
-from qiskit.tools.visualization import circuit_drawer, plot_histogram
-def simulate_e91_protocol(numberOfSinglets):
     # Creating registers
     qr = QuantumRegister(2, name="qr")
     cr = ClassicalRegister(4, name="cr")
@@ -69,109 +133,181 @@ def simulate_e91_protocol(numberOfSinglets):
     aliceMeasurements = [measureA1, measureA2, measureA3]
     bobMeasurements = [measureB1, measureB2, measureB3]
 
-
-    # Define the number of singlets N
-
-
-
-    aliceMeasurementChoices = [random.randint(1, 3) for i in range(numberOfSinglets)] # string b of Alice
-    bobMeasurementChoices = [random.randint(1, 3) for i in range(numberOfSinglets)] # string b' of Bob
-
-    circuits = []  # the list in which the created circuits will be stored
-
-    for i in range(numberOfSinglets):
-        # create the name of the i-th circuit depending on Alice's and Bob's measurement choices
-        circuitName = str(i) + ':A' + str(aliceMeasurementChoices[i]) + '_B' + str(bobMeasurementChoices[i])
-
-        # create the joint measurement circuit
-        # add Alice's and Bob's measurement circuits to the singlet state curcuit
-        # singlet state circuit # measurement circuit of Alice # measurement circuit of Bob
-        #circuitName = singlet + aliceMeasurements[aliceMeasurementChoices[i] - 1] + bobMeasurements[
-            #bobMeasurementChoices[i] - 1]
-        circuitName = singlet.compose(aliceMeasurements[aliceMeasurementChoices[i] - 1]).compose(
-            bobMeasurements[bobMeasurementChoices[i] - 1])
-        # add the created circuit to the circuits list
-        circuits.append(circuitName)
-
-
-    backend=Aer.get_backend('qasm_simulator')
-    result = execute(circuits, backend=backend, shots=1).result()
-    #print(result) # uncomment for detailed result
-
-    print(result.get_counts(circuits[0]))
-
-
-    abPatterns = [
-        re.compile('..00$'), # search for the '..00' output (Alice obtained -1 and Bob obtained -1)
-        re.compile('..01$'), # search for the '..01' output
-        re.compile('..10$'), # search for the '..10' output (Alice obtained -1 and Bob obtained 1)
-        re.compile('..11$')  # search for the '..11' output
-    ]
-
-
-    # create a list to store the results
-
-    aliceResults = []  # Alice's results (string a)
-    bobResults = []  # Bob's results (string a')
-
-    for i in range(numberOfSinglets):
-        res = list(result.get_counts(circuits[i]).keys())[0]
-        if abPatterns[0].search(res):
-            aliceResults.append(1)
-            bobResults.append(1)
-        if abPatterns[1].search(res):
-            aliceResults.append(0)
-            bobResults.append(1)
-        if abPatterns[2].search(res):
-            aliceResults.append(1)
-            bobResults.append(0)
-        if abPatterns[3].search(res):
-            aliceResults.append(0)
-            bobResults.append(0)
-
-    aliceKey = []
-    bobKey = []
-
-    for i in range(numberOfSinglets):
-        if (aliceMeasurementChoices[i] == 2 and bobMeasurementChoices[i] == 1) or (
-                aliceMeasurementChoices[i] == 3 and bobMeasurementChoices[i] == 2):
-            if aliceResults[i] == bobResults[i]:  # Only append when Alice's and Bob's results match
-                aliceKey.append(aliceResults[i])
-                bobKey.append(bobResults[i])
-
-    keyLength = len(aliceKey)  # length of the secret key
-
-
-    abKeyMismatches = 0 # number of mismatching bits in Alice's and Bob's keys
-
-    for j in range(keyLength):
-        if aliceKey[j] != bobKey[j]:
-            abKeyMismatches += 1
-
-    print("The number of mismatching bits in Alice's and Bob's keys is", abKeyMismatches)
-    print("The length of the secret key is", keyLength)
-    print("The secret key is", aliceKey)
-    print("The secret key is", bobKey)
+    return singlet, aliceMeasurements, bobMeasurements
+
+# The singlet and the six measurement sub-circuits never change, so they are built once per process
+_e91_circuits = None
+_e91_combination_circuits = None
+
+def get_e91_circuits():
+    global _e91_circuits
+    if _e91_circuits is None:
+        _e91_circuits = build_e91_circuits()
+    return _e91_circuits
+
+def get_e91_combination_circuits():
+    # Transpiled joint circuit of every (A, B) choice, indexed by (A - 1) * 3 + (B - 1)
+    global _e91_combination_circuits
+    if _e91_combination_circuits is None:
+        singlet, aliceMeasurements, bobMeasurements = get_e91_circuits()
+        _e91_combination_circuits = [
+            get_template(("e91", a, b), lambda a=a, b=b: singlet.compose(aliceMeasurements[a]).compose(bobMeasurements[b]))
+            for a in range(3) for b in range(3)]
+    return _e91_combination_circuits
+
+def build_e91_channel_circuit(combination, interception, channel):
+    # Joint circuit of one (A, B) choice with Eve measuring Bob's qubit into cr[2] along one of
+    # Bob's directions and resending it, followed by the channel's Aer errors
+    singlet, aliceMeasurements, bobMeasurements = get_e91_circuits()
+    qc = singlet.copy()
+    qr, cr = qc.qregs[0], qc.cregs[0]
+    if interception != no_interception:
+        eve_gates = e91_bob_measurements[interception - 1]
+        for gate in eve_gates:
+            getattr(qc, gate)(qr[1])
+        qc.measure(qr[1], cr[2])
+        for gate in reversed(eve_gates):
+            getattr(qc, inverse_gates[gate])(qr[1])
+    for error, qubits in channel.aer_errors([qr[0], qr[1]]):
+        qc.append(error, qubits)
+    return qc.compose(aliceMeasurements[combination // 3]).compose(bobMeasurements[combination % 3])
+
+@timed("sift")
+def sift_e91_results(aliceMeasurementChoices, bobMeasurementChoices, outcomes):
+    # outcomes packs cr[0] (Alice) in bit 0 and cr[1] (Bob) in bit 1 of each singlet
+    aliceResults = 1 - (outcomes & 1)  # Alice's results (string a)
+    bobResults = 1 - (outcomes >> 1)  # Bob's results (string a')
+
+    # (A2, B1) and (A3, B2) share a basis. The singlet gives opposite results there,
+    # so Bob inverts his bit.
+    keyMask = ((aliceMeasurementChoices == 2) & (bobMeasurementChoices == 1)) | (
+            (aliceMeasurementChoices == 3) & (bobMeasurementChoices == 2))
+    aliceKey = aliceResults[keyMask]
+    bobKey = 1 - bobResults[keyMask]
 
     return aliceKey, bobKey
 
-def e91_qkd_protocol(desired_key_length):
-    final_alice_key = []
-    final_bob_key = []
-
-    while len(final_alice_key) < desired_key_length and len(final_bob_key) < desired_key_length:
-        aliceKey, bobKey = simulate_e91_protocol(desired_key_length)
-        final_alice_key.extend(aliceKey)
-        final_bob_key.extend(bobKey)
+def e91_correlations(aliceMeasurementChoices, bobMeasurementChoices, outcomes):
+    # Sum of the spin products (+1/-1) and number of singlets for every (A, B) combination
+    combination = (aliceMeasurementChoices - 1) * 3 + (bobMeasurementChoices - 1)
+    spinProducts = 1 - 2 * ((outcomes & 1) ^ (outcomes >> 1)).astype(np.int64)
+    sums = np.bincount(combination, weights=spinProducts, minlength=9).reshape(3, 3)
+    counts = np.bincount(combination, minlength=9).reshape(3, 3)
+    return sums, counts
+
+def chsh_value(correlationSums, correlationCounts):
+    # S = E(a1, b1) - E(a1, b3) + E(a3, b1) + E(a3, b3), -2*sqrt(2) for an undisturbed singlet.
+    # None when a basis pair has no singlets, as for short keys or a lossy channel.
+    if np.any(correlationCounts[::2, ::2] == 0):
+        return None
+    expectation = correlationSums / correlationCounts
+    return float(expectation[0, 0] - expectation[0, 2] + expectation[2, 0] + expectation[2, 2])
+
+def simulate_e91_protocol(numberOfSinglets, backend="aer", mode="grouped", channel=None, rng=None,
+                          seed_simulator=None):
+    rng = rng or get_rng()
+    aliceMeasurementChoices = rng.integers(1, 4, size=numberOfSinglets) # string b of Alice
+    bobMeasurementChoices = rng.integers(1, 4, size=numberOfSinglets) # string b' of Bob
+    if backend == "aer":
+        seed_simulator = simulator_seed(rng, seed_simulator)
+
+    if channel is not None:
+        if backend == "aer" and mode != "grouped":
+            raise ValueError("Channel simulation on Aer needs the grouped mode")
+        # Pairs with a lost photon never reach the sifting stage
+        detected = sample_detections(numberOfSinglets, channel, photons=2, rng=rng)
+        aliceMeasurementChoices = aliceMeasurementChoices[detected]
+        bobMeasurementChoices = bobMeasurementChoices[detected]
+        interceptions = sample_interceptions(len(aliceMeasurementChoices), channel, bases=3, rng=rng)
+        if backend == "analytic":
+            outcomes = sample_e91_channel(aliceMeasurementChoices, bobMeasurementChoices, interceptions, channel,
+                                          rng=rng)
+        else:
+            outcomes = run_e91_grouped(aliceMeasurementChoices, bobMeasurementChoices, interceptions, channel,
+                                       seed_simulator=seed_simulator)
+    elif backend == "analytic":
+        # Sample every singlet's outcome from the exact joint probabilities
+        outcomes = sample_e91(aliceMeasurementChoices, bobMeasurementChoices, rng=rng)
+    elif mode == "grouped":
+        outcomes = run_e91_grouped(aliceMeasurementChoices, bobMeasurementChoices, seed_simulator=seed_simulator)
+    else:
+        outcomes = run_e91_circuits(aliceMeasurementChoices, bobMeasurementChoices, seed_simulator=seed_simulator)
+
+    aliceKey, bobKey = sift_e91_results(aliceMeasurementChoices, bobMeasurementChoices, outcomes)
+
+    # The non-key basis pairs estimate CHSH for eavesdropping detection
+    correlationSums, correlationCounts = e91_correlations(aliceMeasurementChoices, bobMeasurementChoices, outcomes)
+    statistics = {
+        "singlets": numberOfSinglets,
+        "key_length": len(aliceKey),
+        "mismatches": int(np.count_nonzero(aliceKey != bobKey)),  # mismatching bits in Alice's and Bob's keys
+        "correlation_sums": correlationSums,
+        "correlation_counts": correlationCounts,
+    }
+
+    logger.debug("E91 round: %d singlets, %d key bits, %d mismatches, CHSH %s", numberOfSinglets,
+                 statistics["key_length"], statistics["mismatches"], chsh_value(correlationSums, correlationCounts))
+
+    return aliceKey, bobKey, statistics
+
+def e91_channel_statistics(numberOfSinglets, channel, backend="analytic", rng=None):
+    # QBER, sifted length and CHSH of numberOfSinglets pairs sent through the channel,
+    # simulated chunk by chunk
+    keyLength = mismatches = 0
+    correlationSums, correlationCounts = np.zeros((3, 3)), np.zeros((3, 3), dtype=np.int64)
+    for start in range(0, numberOfSinglets, channel_chunk_size):
+        _, _, statistics = simulate_e91_protocol(min(channel_chunk_size, numberOfSinglets - start),
+                                                 backend=backend, channel=channel, rng=rng)
+        keyLength += statistics["key_length"]
+        mismatches += statistics["mismatches"]
+        correlationSums += statistics["correlation_sums"]
+        correlationCounts += statistics["correlation_counts"]
+    return {
+        "protocol": "E91",
+        "singlets": numberOfSinglets,
+        "sifted_bits": keyLength,
+        "errors": mismatches,
+        "qber": mismatches / keyLength if keyLength else None,
+        "key_yield": keyLength / numberOfSinglets if numberOfSinglets else None,
+        "chsh": chsh_value(correlationSums, correlationCounts),
+        "channel": channel.as_dict(),
+    }
+
+def estimate_singlets(remaining_bits, safety_margin=e91_safety_margin):
+    # Predict the singlets needed for the remaining bits from the sifting rate
+    return max(e91_min_round_singlets, math.ceil(remaining_bits / e91_sifting_rate * (1 + safety_margin)))
+
+def e91_qkd_protocol(desired_key_length, backend="aer", mode="grouped", safety_margin=e91_safety_margin,
+                     return_statistics=False, channel=None, rng=None, seed_simulator=None):
+    check_channel_delivers(channel)
+    alice_parts, bob_parts = [], []
+    key_length = rounds = 0
+    totals = {"singlets": 0, "key_length": 0, "mismatches": 0,
+              "correlation_sums": np.zeros((3, 3)), "correlation_counts": np.zeros((3, 3), dtype=np.int64)}
+
+    # The first round is sized for the whole key, later rounds only top up the shortfall
+    while key_length < desired_key_length:
+        numberOfSinglets = estimate_singlets(desired_key_length - key_length, safety_margin)
+        aliceKey, bobKey, statistics = simulate_e91_protocol(
+            numberOfSinglets, backend=backend, mode=mode, channel=channel, rng=rng,
+            seed_simulator=None if seed_simulator is None else seed_simulator + rounds)
+        rounds += 1
+        alice_parts.append(QKDKey.from_bits(aliceKey))
+        bob_parts.append(QKDKey.from_bits(bobKey))
+        key_length += len(aliceKey)
+        for name in totals:
+            totals[name] = totals[name] + statistics[name]
 
     # Truncate the keys to the desired length
-    final_alice_key = final_alice_key[:desired_key_length]
-    final_bob_key = final_bob_key[:desired_key_length]
-
-    # Convert the keys to strings
-    final_alice_key = ''.join(map(str, final_alice_key))
-    final_bob_key = ''.join(map(str, final_bob_key))
-
+    final_alice_key = QKDKey.concatenate(alice_parts)[:desired_key_length]
+    final_bob_key = QKDKey.concatenate(bob_parts)[:desired_key_length]
+
+    if return_statistics:
+        statistics = {
+            "singlets": totals["singlets"],
+            "sifted_bits": totals["key_length"],
+            "key_mismatches": totals["mismatches"],
+            "chsh": chsh_value(totals["correlation_sums"], totals["correlation_counts"]),
+        }
+        return final_alice_key, final_bob_key, statistics
     return final_alice_key, final_bob_key
-
-
@@ -0,0 +1,54 @@
+import numpy as np
+
+from generate_e91_key import (decode_e91_memory, e91_qkd_protocol, estimate_singlets, get_e91_circuits, sift_e91_results,
+                              get_e91_combination_circuits)
+
+
+def test_decode_e91_memory_reads_the_last_two_clbits():
+    assert decode_e91_memory(["0000", "0001", "0010", "0011"]).tolist() == [0, 1, 2, 3]
+    assert decode_e91_memory([]).tolist() == []
+
+
+def test_grouped_and_per_singlet_modes_produce_matching_keys():
+    for mode in ("grouped", "per_singlet"):
+        alice_key, bob_key = e91_qkd_protocol(128, mode=mode)
+        assert len(alice_key) == 128
+        assert alice_key == bob_key
+
+
+def test_measurement_circuits_are_built_once():
+    assert get_e91_circuits() is get_e91_circuits()
+    assert get_e91_combination_circuits() is get_e91_combination_circuits()
+    assert len(get_e91_combination_circuits()) == 9
+
+
+def test_estimate_singlets_covers_the_sifting_rate():
+    assert estimate_singlets(2000, safety_margin=0) == 9000
+    assert estimate_singlets(2000, safety_margin=0.1) == 9900
+    assert estimate_singlets(1) == 32
+
+
+def test_sifting_inverts_bob_and_keeps_only_shared_bases():
+    alice_choices = np.array([2, 3, 1, 2, 3])
+    bob_choices = np.array([1, 2, 1, 2, 3])
+    outcomes = np.array([1, 2, 0, 3, 3], dtype=np.uint8)
+    alice_key, bob_key = sift_e91_results(alice_choices, bob_choices, outcomes)
+    assert alice_key.tolist() == [0, 1]
+    assert bob_key.tolist() == [0, 1]
+
+
+def test_chsh_value_of_an_undisturbed_singlet():
+    _, _, statistics = e91_qkd_protocol(20000, backend="analytic", return_statistics=True)
+    assert statistics["key_mismatches"] == 0
+    assert abs(statistics["chsh"] + 2 * np.sqrt(2)) < 0.15
+
+
+def test_chsh_is_none_without_singlets_in_every_basis_pair():
+    from generate_e91_key import chsh_value
+    counts = np.ones((3, 3), dtype=np.int64)
+    counts[2, 0] = 0
+    assert chsh_value(np.zeros((3, 3)), counts) is None
+    for seed in range(50):
+        _, _, statistics = e91_qkd_protocol(1, backend="analytic", return_statistics=True,
+                                            rng=np.random.default_rng(seed))
+        assert statistics["chsh"] is None or -4 <= statistics["chsh"] <= 4
@@ -1,80 +1,389 @@
-from fastapi import FastAPI, HTTPException
-
-from app_functions import quantum_compute
-from app_functions import generate_code
-from app_functions import get_correct_measurements
-from generate_bb84_key import bb84_qkd_protocol
-from generate_e91_key import e91_qkd_protocol, simulate_e91_protocol
-import random
-import time
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-def generate_random_pairings(length):
-    all_pairings = [[[0,1], [2,3]], [[0,2], [1,3]], [[0,3], [1,2]]]
-    return [random.choice(all_pairings) for _ in range(length)]
-def generate_random_groupings(length):
-    return [random.randint(0,1) for _ in range(length)]
+from app_functions import get_outcome_table, quantum_compute_modes
+from analytic_backend import backends
+from generate_bs_key import bs_qkd_protocol
+from generate_bb84_key import bb84_qkd_protocol, bb84_channel_statistics
+from generate_e91_key import e91_qkd_protocol, e91_modes, e91_channel_statistics
+from channel_model import ChannelModel, channel_max_qubits, channel_max_aer_qubits
+from worker_pool import WorkerPool, PoolSaturated
+from key_pool import KeyReservoir
+from key_management import create_key_management_router
+from post_processing import post_processed_protocol
+from key_stream import (generate_key_rounds, encode_key_rounds, stream_formats, stream_parties,
+                        stream_media_types, stream_max_bits)
+from metrics import configure_logging, count, render_metrics, set_gauge
+from key_jobs import KeyJob, KeyJobStore, JobStoreFull, job_max_bits
+import asyncio
+import os
+import time
 
 correction_bits = 1
+# Limits of one POST /batch_keys call
+batch_max_requests = int(os.environ.get("QKD_BATCH_MAX_REQUESTS", 256))
+batch_max_bits = int(os.environ.get("QKD_BATCH_MAX_BITS", 1 << 22))
+
+configure_logging()
 
 app = FastAPI()
 
+# Simulation runs in worker processes so one key request never blocks the event loop
+worker_pool = WorkerPool()
+
+# Pre-generated key bits per protocol, refilled in the background with the default options
+key_pools = {
+    "BS": KeyReservoir("BS", lambda n_bits: worker_pool.run(bs_qkd_protocol, n_bits),
+                       {"mode": "table", "round_size": None, "backend": "aer"}),
+    "BB84": KeyReservoir("BB84", lambda n_bits: worker_pool.run(bb84_qkd_protocol, n_bits),
+                         {"backend": "analytic"}),
+    "E91": KeyReservoir("E91", lambda n_bits: worker_pool.run(e91_qkd_protocol, n_bits, return_statistics=True),
+                        {"backend": "aer", "mode": "grouped"}),
+}
+
+# Long keys as asynchronous jobs: POST /jobs, then poll or long-poll GET /jobs/{job_id}
+key_jobs = KeyJobStore(worker_pool)
+
+@app.on_event("startup")
+async def build_bs_outcome_table():
+    # Simulate the 144 (Alice, Bob) BS circuits once so requests only do lookups,
+    # the pool hands the table to every worker it starts
+    get_outcome_table()
+    worker_pool.start()
+    for key_pool in key_pools.values():
+        key_pool.start()
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    key_jobs.shutdown()
+    for key_pool in key_pools.values():
+        await key_pool.stop()
+    worker_pool.shutdown()
+
+def take_from_key_pool(protocol, desired_key_length, options):
+    key_pool = key_pools[protocol]
+    if not key_pool.matches(options):
+        count("qkd_key_pool_requests_total", protocol=protocol, result="bypass")
+        return None
+    keys = key_pool.take(desired_key_length)
+    count("qkd_key_pool_requests_total", protocol=protocol, result="miss" if keys is None else "hit")
+    return keys
+
+protocol_functions = {"BS": bs_qkd_protocol, "BB84": bb84_qkd_protocol, "E91": e91_qkd_protocol}
+
+async def generate_protocol_keys(protocol, n_bits):
+    # Default-option keys, from the reservoir when it is deep enough
+    keys = take_from_key_pool(protocol, n_bits, key_pools[protocol].options)
+    if keys is None:
+        keys = await run_in_pool(protocol_functions[protocol], n_bits)
+    return keys
+
+# ETSI GS QKD 014-style bulk key delivery under /api/v1/keys
+app.include_router(create_key_management_router(generate_protocol_keys))
+
+async def run_in_pool(fn, *args, **kwargs):
+    try:
+        return await worker_pool.run(fn, *args, **kwargs)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=503, detail="Key generation pool is saturated, retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+
+def post_processing_statistics(statistics):
+    # Leaked-bit and throughput report of post_processed_protocol, without protocol statistics
+    keys = ("raw_bits", "qber", "sampled_bits", "leaked_bits", "corrected_bits", "verified", "residual_errors",
+            "final_bits", "reconciliation_time", "amplification_time", "throughput")
+    return {key: statistics[key] for key in keys}
+
+# /key is the original route of the chat application and serves BS keys
+@app.get("/key/{desired_key_length}")
 @app.get("/bs_key/{desired_key_length}")
-async def get_bs_key(desired_key_length: int):
+async def get_bs_key(desired_key_length: int, mode: str = "table", round_size: int | None = None,
+                     backend: str = "aer", post_process: bool = False):
     if desired_key_length <= 0:
         raise HTTPException(status_code=400, detail="Number of bits must be positive")
-    desired_key_length = desired_key_length
+    if backend not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
+    if mode not in quantum_compute_modes:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {', '.join(quantum_compute_modes)}")
+    if round_size is not None and round_size <= 0:
+        raise HTTPException(status_code=400, detail="Round size must be positive")
     start_time = time.time()  # Start the timer
-    alice_code, bob_code = "", ""
-    while len(alice_code) <= desired_key_length:
-        # Generate random pairings and groupings for Alice and Bob
-        alice_pairings = generate_random_pairings(10)
-        alice_groupings = generate_random_groupings(10)
-        bob_pairings = generate_random_pairings(10)
-        bob_groupings = generate_random_groupings(10)
-        alice_json = {"pairings": alice_pairings, "groupings": alice_groupings, "correct_measurements": []}
-        bob_json = {"pairings": bob_pairings, "groupings": bob_groupings, "correct_measurements": []}
-        alice_json, bob_json = quantum_compute(alice_json, bob_json)
-        alice_json, bob_json = quantum_compute(alice_json, bob_json)
-        alice_json["code"] = generate_code(alice_json["correct_measurements"])
-        bob_json["code"] = generate_code(bob_json["correct_measurements"])
-        alice_code += alice_json["code"]
-        bob_code += bob_json["code"]
-
-    alice_code = alice_code[:desired_key_length]
-    bob_code = bob_code[:desired_key_length]
+    if post_process:
+        # Reconciled and privacy-amplified keys are never taken from the reservoir
+        alice_code, bob_code, statistics = await run_in_pool(post_processed_protocol, bs_qkd_protocol,
+                                                             desired_key_length, mode=mode, round_size=round_size,
+                                                             backend=backend)
+        end_time = time.time()
+        return {"alice_key": str(alice_code), "bob_key": str(bob_code), "time_taken": end_time - start_time,
+                "protocol": "BS", "from_pool": False, "post_processing": post_processing_statistics(statistics)}
+    keys = take_from_key_pool("BS", desired_key_length, {"mode": mode, "round_size": round_size, "backend": backend})
+    from_pool = keys is not None
+    if not from_pool:
+        keys = await run_in_pool(bs_qkd_protocol, desired_key_length, mode=mode,
+                                 round_size=round_size, backend=backend)
+    alice_code, bob_code = keys
     end_time = time.time()  # Stop the timer
     time_taken = end_time - start_time  # Calculate the time taken
     # Return the keys
-    return {"alice_key": alice_code, "bob_key": bob_code, "time_taken": time_taken, "protocol": "BS"}
+    return {"alice_key": str(alice_code), "bob_key": str(bob_code), "time_taken": time_taken, "protocol": "BS",
+            "from_pool": from_pool}
 
 
 @app.get("/bb84_key/{desired_key_length}")
-async def get_vv84_key(desired_key_length: int):
+async def get_vv84_key(desired_key_length: int, backend: str = "analytic", post_process: bool = False):
     if desired_key_length <= 0:
         raise HTTPException(status_code=400, detail="Number of bits must be positive")
+    if backend not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
 
     st = time.time()
 
-    shared_key = bb84_qkd_protocol(desired_key_length)
+    if post_process:
+        alice_key, bob_key, statistics = await run_in_pool(post_processed_protocol, bb84_qkd_protocol,
+                                                           desired_key_length, backend=backend)
+        et = time.time()
+        return {"alice_key": str(alice_key), "bob_key": str(bob_key), "time_taken": str(et - st), "protocol": "BB84",
+                "from_pool": False, "post_processing": post_processing_statistics(statistics)}
+
+    keys = take_from_key_pool("BB84", desired_key_length, {"backend": backend})
+    from_pool = keys is not None
+    if not from_pool:
+        keys = await run_in_pool(bb84_qkd_protocol, desired_key_length, backend=backend)
+    alice_key, bob_key = keys
 
     et = time.time()
 
     time_taken = et - st
 
-    return {"alice_key": shared_key, "bob_key": shared_key, "time_taken": str(time_taken) , "protocol": "BB84"}
+    return {"alice_key": str(alice_key), "bob_key": str(bob_key), "time_taken": str(time_taken) , "protocol": "BB84",
+            "from_pool": from_pool}
 
 
 @app.get("/e91_key/{desired_key_length}")
-async def get_e91_key(desired_key_length: int):
+async def get_e91_key(desired_key_length: int, backend: str = "aer", mode: str = "grouped",
+                      post_process: bool = False):
     if desired_key_length <= 0:
         raise HTTPException(status_code=400, detail="Number of bits must be positive")
+    if backend not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
+    if mode not in e91_modes:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {', '.join(e91_modes)}")
 
     st = time.time()
 
-    alice_key, bob_key = e91_qkd_protocol(desired_key_length)
+    if post_process:
+        alice_key, bob_key, statistics = await run_in_pool(post_processed_protocol, e91_qkd_protocol,
+                                                           desired_key_length, backend=backend, mode=mode,
+                                                           return_statistics=True)
+        et = time.time()
+        return {"alice_key": str(alice_key), "bob_key": str(bob_key), "time_taken": str(et - st), "protocol": "E91",
+                "chsh": statistics["chsh"], "key_mismatches": statistics["key_mismatches"], "from_pool": False,
+                "post_processing": post_processing_statistics(statistics)}
+
+    keys = take_from_key_pool("E91", desired_key_length, {"backend": backend, "mode": mode})
+    from_pool = keys is not None
+    if from_pool:
+        # Pooled bits report the statistics of the latest refill round
+        alice_key, bob_key = keys
+        statistics = key_pools["E91"].statistics or {"chsh": None, "key_mismatches": None}
+    else:
+        alice_key, bob_key, statistics = await run_in_pool(e91_qkd_protocol, desired_key_length, backend=backend,
+                                                           mode=mode, return_statistics=True)
 
     et = time.time()
 
     time_taken = et - st
 
-    return {"alice_key": alice_key, "bob_key": bob_key, "time_taken": str(time_taken) , "protocol": "E91"}
\ No newline at end of file
+    return {"alice_key": str(alice_key), "bob_key": str(bob_key), "time_taken": str(time_taken) , "protocol": "E91",
+            "chsh": statistics["chsh"], "key_mismatches": statistics["key_mismatches"], "from_pool": from_pool}
+
+
+channel_statistics_functions = {"bb84": bb84_channel_statistics, "e91": e91_channel_statistics}
+
+@app.get("/channel_statistics/{protocol}/{n_qubits}")
+async def get_channel_statistics(protocol: str, n_qubits: int, depolarizing: float = 0.0, bit_flip: float = 0.0,
+                                 loss: float = 0.0, interception: float = 0.0, backend: str = "analytic"):
+    # QBER, sifted length and (E91) CHSH of n_qubits sent through a noisy channel with an eavesdropper
+    if protocol not in channel_statistics_functions:
+        raise HTTPException(status_code=400,
+                            detail=f"Protocol must be one of {', '.join(channel_statistics_functions)}")
+    if backend not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
+    max_qubits = channel_max_aer_qubits if backend == "aer" else channel_max_qubits
+    if not 0 < n_qubits <= max_qubits:
+        raise HTTPException(status_code=400, detail=f"Number of qubits must be between 1 and {max_qubits}")
+    try:
+        channel = ChannelModel(depolarizing, bit_flip, loss, interception)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    st = time.time()
+    statistics = await run_in_pool(channel_statistics_functions[protocol], n_qubits, channel, backend=backend)
+    statistics["time_taken"] = time.time() - st
+    return statistics
+
+
+@app.get("/key_pool")
+async def get_key_pool_status():
+    return {protocol: key_pool.status() for protocol, key_pool in key_pools.items()}
+
+
+class JobRequest(BaseModel):
+    protocol: str
+    key_length: int
+    options: dict = {}
+
+
+# Options a job may pass to its protocol function, checked like the query parameters of the key routes
+job_options = {"BS": ("mode", "round_size", "backend"), "BB84": ("backend",), "E91": ("backend", "mode")}
+
+def check_job_request(request):
+    if request.protocol not in job_options:
+        raise HTTPException(status_code=400, detail=f"Protocol must be one of {', '.join(job_options)}")
+    if not 0 < request.key_length <= job_max_bits:
+        raise HTTPException(status_code=400, detail=f"Number of bits must be between 1 and {job_max_bits}")
+    unknown = set(request.options) - set(job_options[request.protocol])
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown {request.protocol} options: {', '.join(sorted(unknown))}")
+    options = request.options
+    if "backend" in options and options["backend"] not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
+    modes = quantum_compute_modes if request.protocol == "BS" else e91_modes
+    if "mode" in options and options["mode"] not in modes:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {', '.join(modes)}")
+    round_size = options.get("round_size")
+    # JSON true is a Python int as well
+    if round_size is not None and (not isinstance(round_size, int) or isinstance(round_size, bool) or round_size <= 0):
+        raise HTTPException(status_code=400, detail="Round size must be positive")
+
+def get_job(job_id):
+    job = key_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
+
+@app.post("/jobs", status_code=202)
+async def create_key_job(request: JobRequest):
+    check_job_request(request)
+    try:
+        job = key_jobs.submit(KeyJob(request.protocol, request.key_length, request.options))
+    except JobStoreFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(worker_pool.retry_after)})
+    return job.progress()
+
+@app.get("/jobs")
+async def list_key_jobs():
+    return {"jobs": [job.progress() for job in key_jobs.jobs()], "running": key_jobs.running}
+
+@app.get("/jobs/{job_id}")
+async def get_key_job(job_id: str, wait: float = 0):
+    # wait > 0 long-polls until the job stops, for at most job_max_wait seconds
+    job = get_job(job_id)
+    if wait > 0:
+        await key_jobs.wait(job, wait)
+    return job.progress()
+
+@app.get("/jobs/{job_id}/keys")
+async def get_key_job_keys(job_id: str):
+    job = get_job(job_id)
+    if job.state != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.state}")
+    alice_key, bob_key = job.keys()
+    return {"alice_key": str(alice_key), "bob_key": str(bob_key), "protocol": job.protocol,
+            "time_taken": job.progress()["elapsed"]}
+
+@app.delete("/jobs/{job_id}")
+async def cancel_key_job(job_id: str):
+    job = get_job(job_id)
+    job.cancel()
+    return job.progress()
+
+
+class BatchRequest(BaseModel):
+    requests: list[JobRequest]
+
+
+async def generate_batch_group(protocol, options, total_bits):
+    # Default options may be served from the reservoir, like the key management routes
+    if not options:
+        return await generate_protocol_keys(protocol, total_bits)
+    return await run_in_pool(protocol_functions[protocol], total_bits, **options)
+
+@app.post("/batch_keys")
+async def get_batch_keys(batch: BatchRequest):
+    # Requests of the same protocol and options are generated as one key of the total
+    # length, which is then split between them in request order
+    if not 0 < len(batch.requests) <= batch_max_requests:
+        raise HTTPException(status_code=400, detail=f"A batch holds between 1 and {batch_max_requests} requests")
+    for request in batch.requests:
+        check_job_request(request)
+    if sum(request.key_length for request in batch.requests) > batch_max_bits:
+        raise HTTPException(status_code=400, detail=f"A batch asks for at most {batch_max_bits} bits")
+
+    st = time.time()
+    groups = {}
+    for i, request in enumerate(batch.requests):
+        groups.setdefault((request.protocol, tuple(sorted(request.options.items()))), []).append(i)
+    group_keys = await asyncio.gather(*(
+        generate_batch_group(protocol, dict(options), sum(batch.requests[i].key_length for i in indices))
+        for (protocol, options), indices in groups.items()))
+
+    keys = [None] * len(batch.requests)
+    for indices, (alice_key, bob_key, *_) in zip(groups.values(), group_keys):
+        start = 0
+        for i in indices:
+            end = start + batch.requests[i].key_length
+            keys[i] = {"protocol": batch.requests[i].protocol, "alice_key": str(alice_key[start:end]),
+                       "bob_key": str(bob_key[start:end])}
+            start = end
+    return {"keys": keys, "simulation_runs": len(groups), "time_taken": time.time() - st}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, stage timings and counters include the pool workers' share
+    set_gauge("qkd_worker_pool_pending", worker_pool.pending)
+    for protocol, key_pool in key_pools.items():
+        set_gauge("qkd_key_pool_bits", key_pool.depth, protocol=protocol)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def stream_response(request, protocol, desired_key_length, format, party, options):
+    if not 0 < desired_key_length <= stream_max_bits:
+        raise HTTPException(status_code=400, detail=f"Number of bits must be between 1 and {stream_max_bits}")
+    if format not in stream_formats:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {', '.join(stream_formats)}")
+    if party not in stream_parties:
+        raise HTTPException(status_code=400, detail=f"Party must be one of {', '.join(stream_parties)}")
+    if options["backend"] not in backends:
+        raise HTTPException(status_code=400, detail=f"Backend must be one of {', '.join(backends)}")
+
+    # Rounds stop being submitted once the client disconnects
+    rounds = generate_key_rounds(worker_pool, protocol_functions[protocol], desired_key_length,
+                                 is_disconnected=request.is_disconnected, **options)
+    return StreamingResponse(encode_key_rounds(rounds, format=format, party=party),
+                             media_type=stream_media_types[format],
+                             headers={"X-Key-Length": str(desired_key_length), "X-Protocol": protocol})
+
+
+@app.get("/bs_key_stream/{desired_key_length}")
+async def stream_bs_key(request: Request, desired_key_length: int, format: str = "binary", party: str = "alice",
+                        mode: str = "table", backend: str = "aer"):
+    if mode not in quantum_compute_modes:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {', '.join(quantum_compute_modes)}")
+    return stream_response(request, "BS", desired_key_length, format, party, {"mode": mode, "backend": backend})
+
+
+@app.get("/bb84_key_stream/{desired_key_length}")
+async def stream_bb84_key(request: Request, desired_key_length: int, format: str = "binary", party: str = "alice",
+                          backend: str = "analytic"):
+    return stream_response(request, "BB84", desired_key_length, format, party, {"backend": backend})
+
+
+@app.get("/e91_key_stream/{desired_key_length}")
+async def stream_e91_key(request: Request, desired_key_length: int, format: str = "binary", party: str = "alice",
+                         backend: str = "aer", mode: str = "grouped"):
+    if mode not in e91_modes:
+        raise HTTPException(status_code=400, detail=f"Mode must be one of {', '.join(e91_modes)}")
+    return stream_response(request, "E91", desired_key_length, format, party, {"backend": backend, "mode": mode})
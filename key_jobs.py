@@ -0,0 +1,202 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from generate_bb84_key import bb84_qkd_protocol
+from generate_bs_key import bs_qkd_protocol
+from generate_e91_key import e91_qkd_protocol
+from metrics import merge_metrics
+from qkd_key import QKDKey
+from worker_pool import pool_workers
+
+# Long keys are generated round by round on the worker pool, so a job reports progress after
+# every round and can be cancelled between rounds. Rounds are a multiple of 8 bits.
+job_round_bits = int(os.environ.get("QKD_JOB_ROUND_BITS", 1 << 14))
+job_protocol_functions = {"BS": bs_qkd_protocol, "BB84": bb84_qkd_protocol, "E91": e91_qkd_protocol}
+job_states = ("queued", "running", "done", "failed", "cancelled")
+# Jobs of the API: finished jobs and their keys are kept for job_ttl seconds, at most
+# job_max_jobs are retained and job_max_running generate at the same time, the rest queue
+job_ttl = float(os.environ.get("QKD_JOB_TTL", 600))
+job_max_jobs = int(os.environ.get("QKD_JOB_MAX_JOBS", 1000))
+job_max_running = int(os.environ.get("QKD_JOB_MAX_RUNNING", pool_workers))
+job_max_bits = int(os.environ.get("QKD_JOB_MAX_BITS", 1 << 27))
+job_max_wait = float(os.environ.get("QKD_JOB_MAX_WAIT", 60))
+job_poll_interval = 0.05
+
+
+class KeyJob:
+    def __init__(self, protocol, desired_key_length, options=None, round_bits=job_round_bits):
+        if protocol not in job_protocol_functions:
+            raise ValueError(f"Protocol must be one of {', '.join(job_protocol_functions)}")
+        if desired_key_length <= 0:
+            raise ValueError("Number of bits must be positive")
+        self.job_id = uuid.uuid4().hex
+        self.protocol = protocol
+        self.desired_key_length = desired_key_length
+        self.options = options or {}
+        self.round_bits = max(8, round_bits - round_bits % 8)
+        self.state = "queued"
+        self.error = None
+        self.generated_bits = 0
+        self.simulator_jobs = 0
+        self.created = time.time()
+        self.started = self.finished = None
+        self._alice_parts, self._bob_parts = [], []
+        self._cancelled = threading.Event()
+
+    @property
+    def active(self):
+        return self.state in ("queued", "running")
+
+    def cancel(self):
+        # Running jobs stop before their next round, queued jobs never start
+        self._cancelled.set()
+        if self.state == "queued":
+            self._finish("cancelled")
+
+    def next_round(self):
+        # Bits to ask the protocol for next, 0 once the job has stopped
+        if self._cancelled.is_set():
+            self._finish("cancelled")
+            return 0
+        if self.state == "queued":
+            self.state, self.started = "running", time.time()
+        return min(self.round_bits, self.desired_key_length - self.generated_bits)
+
+    def add_round(self, keys, collected):
+        # keys is a protocol result, collected the metrics the worker recorded for it
+        merge_metrics(collected)
+        self.simulator_jobs += collected[1].get(("qkd_simulator_jobs_total", ()), 0)
+        self._alice_parts.append(keys[0])
+        self._bob_parts.append(keys[1])
+        self.generated_bits += len(keys[0])
+        if self.generated_bits >= self.desired_key_length:
+            self._finish("done")
+
+    def fail(self, error):
+        self.error = str(error)
+        self._finish("failed")
+
+    def _finish(self, state):
+        self.state, self.finished = state, time.time()
+
+    def run(self, worker_pool):
+        # Blocking driver for threads, every round runs on the worker pool
+        try:
+            while self.active:
+                n_bits = self.next_round()
+                if n_bits:
+                    function = job_protocol_functions[self.protocol]
+                    self.add_round(*worker_pool.submit(function, n_bits, **self.options).result())
+        except Exception as e:
+            self.fail(e)
+
+    async def run_async(self, worker_pool):
+        # Event loop driver for the API, the loop stays free while a round runs
+        try:
+            while self.active:
+                n_bits = self.next_round()
+                if n_bits:
+                    function = job_protocol_functions[self.protocol]
+                    future = worker_pool.submit(function, n_bits, **self.options)
+                    self.add_round(*await asyncio.wrap_future(future))
+        except Exception as e:
+            self.fail(e)
+
+    def start(self, worker_pool):
+        threading.Thread(target=self.run, args=(worker_pool,), daemon=True).start()
+        return self
+
+    def keys(self):
+        alice_key = QKDKey.concatenate(self._alice_parts)[:self.desired_key_length]
+        bob_key = QKDKey.concatenate(self._bob_parts)[:self.desired_key_length]
+        return alice_key, bob_key
+
+    def progress(self):
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        return {
+            "job_id": self.job_id,
+            "protocol": self.protocol,
+            "state": self.state,
+            "desired_key_length": self.desired_key_length,
+            "generated_bits": min(self.generated_bits, self.desired_key_length),
+            "bits_per_second": self.generated_bits / elapsed if elapsed else 0.0,
+            "simulator_jobs": self.simulator_jobs,
+            "elapsed": elapsed,
+            "error": self.error,
+        }
+
+
+class JobStoreFull(Exception):
+    pass
+
+
+class KeyJobStore:
+    def __init__(self, worker_pool, ttl=job_ttl, max_jobs=job_max_jobs, max_running=job_max_running):
+        self.worker_pool = worker_pool
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.max_running = max_running
+        self.running = 0
+        self._jobs = {}
+        self._queue = deque()
+        self._tasks = set()
+
+    def evict(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if not job.active and now - job.finished > self.ttl:
+                del self._jobs[job_id]
+
+    def submit(self, job):
+        # Must be called from the event loop, the job starts once a running slot is free
+        self.evict()
+        if len(self._jobs) >= self.max_jobs:
+            raise JobStoreFull(f"At most {self.max_jobs} jobs are kept")
+        self._jobs[job.job_id] = job
+        self._queue.append(job)
+        self._schedule()
+        return job
+
+    def _schedule(self):
+        while self._queue and self.running < self.max_running:
+            job = self._queue.popleft()
+            if not job.active:
+                continue
+            self.running += 1
+            task = asyncio.get_running_loop().create_task(job.run_async(self.worker_pool))
+            self._tasks.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        if task in self._tasks:
+            self._tasks.discard(task)
+            self.running -= 1
+            self._schedule()
+
+    def get(self, job_id):
+        self.evict()
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        self.evict()
+        return list(self._jobs.values())
+
+    async def wait(self, job, timeout):
+        # Long poll: returns once the job has stopped or after timeout seconds
+        deadline = time.monotonic() + min(timeout, job_max_wait)
+        while job.active and time.monotonic() < deadline:
+            await asyncio.sleep(job_poll_interval)
+        return job
+
+    def shutdown(self):
+        for job in self._jobs.values():
+            job.cancel()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._queue.clear()
+        self.running = 0
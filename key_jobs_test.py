@@ -0,0 +1,56 @@
+import pytest
+
+from key_jobs import KeyJob
+from worker_pool import WorkerPool
+
+
+@pytest.fixture(scope="module")
+def worker_pool():
+    pool = WorkerPool(max_workers=1)
+    yield pool
+    pool.shutdown()
+
+
+def test_job_generates_the_key_round_by_round(worker_pool):
+    job = KeyJob("E91", 100, {"backend": "aer"}, round_bits=44)
+    job.run(worker_pool)
+    alice_key, bob_key = job.keys()
+    assert job.state == "done" and job.round_bits == 40
+    assert len(alice_key) == 100 and alice_key == bob_key
+    progress = job.progress()
+    assert progress["generated_bits"] == 100 and progress["bits_per_second"] > 0
+    assert progress["simulator_jobs"] >= 3
+
+
+def test_cancelled_job_stops_before_the_next_round(worker_pool):
+    job = KeyJob("BB84", 1000)
+    job.cancel()
+    job.run(worker_pool)
+    assert job.state == "cancelled" and job.generated_bits == 0
+
+
+def test_failed_round_fails_the_job(worker_pool):
+    job = KeyJob("BB84", 64, {"backend": "unknown"})
+    job.run(worker_pool)
+    assert job.state == "failed" and "backend" in job.error
+
+
+def test_unknown_protocol_is_rejected():
+    with pytest.raises(ValueError):
+        KeyJob("B92", 64)
+
+
+def test_finished_jobs_expire_after_the_ttl(worker_pool):
+    import asyncio
+    from key_jobs import KeyJobStore
+
+    async def run():
+        store = KeyJobStore(worker_pool, ttl=0.2, max_jobs=1)
+        job = store.submit(KeyJob("BB84", 64))
+        await store.wait(job, 30)
+        assert job.state == "done" and store.get(job.job_id) is job
+        await asyncio.sleep(0.3)
+        assert store.get(job.job_id) is None
+        store.submit(KeyJob("BB84", 64))
+
+    asyncio.run(run())
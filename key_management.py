@@ -0,0 +1,145 @@
+import base64
+import os
+import time
+import uuid
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from qkd_key import QKDKey
+
+# Key delivery modelled on ETSI GS QKD 014: the master SAE fetches keys with enc_keys,
+# the slave SAE fetches the matching keys by key_ID with dec_keys
+kme_id = os.environ.get("QKD_KME_ID", "KME_A")
+kme_target_id = os.environ.get("QKD_KME_TARGET_ID", "KME_B")
+kme_protocol = os.environ.get("QKD_KME_PROTOCOL", "BB84")
+kme_default_key_size = int(os.environ.get("QKD_KME_KEY_SIZE", 256))
+kme_min_key_size = 64
+kme_max_key_size = int(os.environ.get("QKD_KME_MAX_KEY_SIZE", 8192))
+kme_max_key_per_request = int(os.environ.get("QKD_KME_MAX_KEY_PER_REQUEST", 128))
+kme_max_key_count = int(os.environ.get("QKD_KME_MAX_KEY_COUNT", 100000))
+
+
+class KeyRequest(BaseModel):
+    number: int = 1
+    size: int | None = None
+
+
+class KeyID(BaseModel):
+    key_ID: str
+
+
+class KeyIDs(BaseModel):
+    key_IDs: list[KeyID]
+
+
+def pack_key(key):
+    # base64 of the packed key bytes, most significant bit first
+    return base64.b64encode(key.to_bytes()).decode()
+
+
+def unpack_key(encoded, size):
+    return QKDKey.from_bytes(base64.b64decode(encoded), size)
+
+
+class KeyStore:
+    # Keys delivered to the master SAE, held until the slave SAE fetches them once
+    def __init__(self, max_key_count=kme_max_key_count):
+        self.max_key_count = max_key_count
+        self._keys = {}
+
+    def stored_key_count(self, slave_SAE_ID):
+        return sum(1 for key in self._keys.values() if key["slave_SAE_ID"] == slave_SAE_ID)
+
+    def add(self, slave_SAE_ID, master_SAE_ID, key):
+        key_ID = str(uuid.uuid4())
+        self._keys[key_ID] = {"slave_SAE_ID": slave_SAE_ID, "master_SAE_ID": master_SAE_ID,
+                              "key": key, "created": time.time()}
+        return key_ID
+
+    def contains(self, key_ID, master_SAE_ID):
+        # Without SAE authentication a key stored without a master_SAE_ID matches any master
+        key = self._keys.get(key_ID)
+        return key is not None and key["master_SAE_ID"] in ("", master_SAE_ID)
+
+    def pop(self, key_ID, master_SAE_ID):
+        if not self.contains(key_ID, master_SAE_ID):
+            return None
+        return self._keys.pop(key_ID)["key"]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def create_key_management_router(generate_keys, key_store=None):
+    # generate_keys(protocol, n_bits) is an async callable returning (alice_key, bob_key)
+    router = APIRouter(prefix="/api/v1/keys")
+    key_store = key_store if key_store is not None else KeyStore()
+    router.key_store = key_store
+
+    def status(slave_SAE_ID, master_SAE_ID=""):
+        return {
+            "source_KME_ID": kme_id,
+            "target_KME_ID": kme_target_id,
+            "master_SAE_ID": master_SAE_ID,
+            "slave_SAE_ID": slave_SAE_ID,
+            "key_size": kme_default_key_size,
+            "stored_key_count": key_store.stored_key_count(slave_SAE_ID),
+            "max_key_count": key_store.max_key_count,
+            "max_key_per_request": kme_max_key_per_request,
+            "max_key_size": kme_max_key_size,
+            "min_key_size": kme_min_key_size,
+            "max_SAE_ID_count": 0,
+        }
+
+    async def enc_keys(slave_SAE_ID, request, master_SAE_ID):
+        size = request.size if request.size is not None else kme_default_key_size
+        if not 1 <= request.number <= kme_max_key_per_request:
+            raise HTTPException(status_code=400,
+                                detail=f"number must be between 1 and {kme_max_key_per_request}")
+        if not kme_min_key_size <= size <= kme_max_key_size or size % 8:
+            raise HTTPException(status_code=400, detail=f"size must be a multiple of 8 between "
+                                                        f"{kme_min_key_size} and {kme_max_key_size}")
+        if len(key_store) + request.number > key_store.max_key_count:
+            raise HTTPException(status_code=503, detail="Key store is full")
+
+        # All requested keys come from one generation run and are split afterwards
+        alice_key, bob_key = await generate_keys(kme_protocol, request.number * size)
+        keys = []
+        for i in range(request.number):
+            alice_bits = alice_key[i * size:(i + 1) * size]
+            bob_bits = bob_key[i * size:(i + 1) * size]
+            key_ID = key_store.add(slave_SAE_ID, master_SAE_ID, pack_key(bob_bits))
+            keys.append({"key_ID": key_ID, "key": pack_key(alice_bits)})
+        return {"keys": keys}
+
+    def dec_keys(master_SAE_ID, key_IDs):
+        # Nothing is released unless every requested key_ID is known
+        unknown = [key_ID for key_ID in key_IDs if not key_store.contains(key_ID, master_SAE_ID)]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown key_ID: {', '.join(unknown)}")
+        return {"keys": [{"key_ID": key_ID, "key": key_store.pop(key_ID, master_SAE_ID)} for key_ID in key_IDs]}
+
+    # As in ETSI 014, enc_keys is addressed by the slave SAE and dec_keys by the master SAE
+
+    @router.get("/{slave_SAE_ID}/status")
+    async def get_status(slave_SAE_ID: str, master_SAE_ID: str = ""):
+        return status(slave_SAE_ID, master_SAE_ID)
+
+    @router.get("/{slave_SAE_ID}/enc_keys")
+    async def get_enc_keys(slave_SAE_ID: str, number: int = 1, size: int | None = None, master_SAE_ID: str = ""):
+        return await enc_keys(slave_SAE_ID, KeyRequest(number=number, size=size), master_SAE_ID)
+
+    @router.post("/{slave_SAE_ID}/enc_keys")
+    async def post_enc_keys(slave_SAE_ID: str, request: KeyRequest, master_SAE_ID: str = ""):
+        return await enc_keys(slave_SAE_ID, request, master_SAE_ID)
+
+    @router.get("/{master_SAE_ID}/dec_keys")
+    async def get_dec_keys(master_SAE_ID: str, key_ID: str):
+        return dec_keys(master_SAE_ID, [key_ID])
+
+    @router.post("/{master_SAE_ID}/dec_keys")
+    async def post_dec_keys(master_SAE_ID: str, request: KeyIDs):
+        return dec_keys(master_SAE_ID, [key.key_ID for key in request.key_IDs])
+
+    return router
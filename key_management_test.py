@@ -0,0 +1,40 @@
+from fastapi.testclient import TestClient
+
+from generate_key import app
+from key_management import pack_key, unpack_key
+from qkd_key import QKDKey
+
+client = TestClient(app)
+
+
+def test_pack_key_round_trips():
+    key = QKDKey.from_string("1011000111110000" * 4)
+    assert unpack_key(pack_key(key), len(key)) == key
+    assert len(pack_key(key)) == 12  # 8 bytes in base64
+
+
+def test_enc_keys_then_dec_keys_by_id():
+    response = client.get("/api/v1/keys/SAE_B/enc_keys?number=5&size=128&master_SAE_ID=SAE_A")
+    assert response.status_code == 200
+    keys = response.json()["keys"]
+    assert len(keys) == 5
+    assert len({key["key_ID"] for key in keys}) == 5
+
+    status = client.get("/api/v1/keys/SAE_B/status").json()
+    assert status["stored_key_count"] == 5
+
+    response = client.post("/api/v1/keys/SAE_A/dec_keys", json={"key_IDs": [{"key_ID": k["key_ID"]} for k in keys]})
+    assert response.status_code == 200
+    assert response.json()["keys"] == keys
+
+    # Every key is delivered to the slave once
+    response = client.get(f"/api/v1/keys/SAE_A/dec_keys?key_ID={keys[0]['key_ID']}")
+    assert response.status_code == 400
+
+
+def test_enc_keys_validates_number_and_size():
+    assert client.post("/api/v1/keys/SAE_B/enc_keys", json={"number": 0}).status_code == 400
+    assert client.post("/api/v1/keys/SAE_B/enc_keys", json={"size": 100}).status_code == 400
+    response = client.post("/api/v1/keys/SAE_B/enc_keys", json={"number": 2})
+    assert response.status_code == 200
+    assert len(unpack_key(response.json()["keys"][0]["key"], 256)) == 256
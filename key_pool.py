@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from qkd_key import QKDKey
+from worker_pool import PoolSaturated
+
+# Every protocol keeps a reservoir of pre-generated key bits. Refill starts when the
+# depth drops below the low-water mark and stops at the high-water mark.
+key_pool_high_water = int(os.environ.get("QKD_KEY_POOL_SIZE", 65536))
+key_pool_low_water = int(os.environ.get("QKD_KEY_POOL_LOW_WATER", key_pool_high_water // 4))
+key_pool_refill_bits = int(os.environ.get("QKD_KEY_POOL_REFILL_BITS", 8192))
+
+
+class KeyReservoir:
+    def __init__(self, protocol, generate, options, high_water=key_pool_high_water,
+                 low_water=key_pool_low_water, refill_bits=key_pool_refill_bits):
+        # generate is an async callable returning (alice_key, bob_key[, statistics]) for a bit count
+        self.protocol = protocol
+        self.generate = generate
+        self.options = options
+        self.high_water = high_water
+        self.low_water = low_water
+        self.refill_bits = refill_bits
+        self.depth = 0
+        self.served_keys = 0
+        self.served_bits = 0
+        self.generated_bits = 0
+        self.refill_rate = 0.0
+        self.statistics = None
+        self._chunks = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def matches(self, options):
+        # Only requests asking for the options the reservoir was filled with are served from it
+        return self.high_water > 0 and options == self.options
+
+    def put(self, alice_key, bob_key):
+        self._chunks.append((alice_key, bob_key))
+        self.depth += len(alice_key)
+        self.generated_bits += len(alice_key)
+
+    def take(self, n_bits):
+        # Hands out the oldest n_bits exactly once, or None when the reservoir is too shallow
+        if n_bits > self.depth:
+            self._wakeup.set()
+            return None
+
+        alice_parts, bob_parts = [], []
+        needed = n_bits
+        while needed:
+            alice_chunk, bob_chunk = self._chunks[0]
+            if len(alice_chunk) <= needed:
+                self._chunks.popleft()
+                alice_parts.append(alice_chunk)
+                bob_parts.append(bob_chunk)
+                needed -= len(alice_chunk)
+            else:
+                alice_parts.append(alice_chunk[:needed])
+                bob_parts.append(bob_chunk[:needed])
+                self._chunks[0] = (alice_chunk[needed:], bob_chunk[needed:])
+                needed = 0
+
+        self.depth -= n_bits
+        self.served_keys += 1
+        self.served_bits += n_bits
+        if self.depth < self.low_water:
+            self._wakeup.set()
+        return QKDKey.concatenate(alice_parts), QKDKey.concatenate(bob_parts)
+
+    async def refill(self):
+        while self.depth < self.high_water:
+            n_bits = min(self.refill_bits, self.high_water - self.depth)
+            start = time.perf_counter()
+            try:
+                generated = await self.generate(n_bits)
+            except PoolSaturated as e:
+                # Client requests take priority over refill
+                await asyncio.sleep(e.retry_after)
+                continue
+            self.refill_rate = n_bits / max(time.perf_counter() - start, 1e-9)
+            if len(generated) > 2:
+                self.statistics = generated[2]
+            self.put(generated[0], generated[1])
+
+    async def refill_forever(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.refill()
+
+    def start(self):
+        if self._task is None and self.high_water > 0:
+            self._task = asyncio.create_task(self.refill_forever())
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self):
+        return {
+            "depth": self.depth,
+            "low_water": self.low_water,
+            "high_water": self.high_water,
+            "refill_rate": self.refill_rate,
+            "generated_bits": self.generated_bits,
+            "served_keys": self.served_keys,
+            "served_bits": self.served_bits,
+            "refilling": self.depth < self.high_water and self._task is not None,
+        }
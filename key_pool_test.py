@@ -0,0 +1,50 @@
+import asyncio
+
+from key_pool import KeyReservoir
+from qkd_key import QKDKey
+
+
+def make_reservoir(**kwargs):
+    async def generate(n_bits):
+        key = QKDKey.from_string("10" * (n_bits // 2) + "1" * (n_bits % 2))
+        return key, key
+    return KeyReservoir("TEST", generate, {"backend": "analytic"}, **kwargs)
+
+
+def test_reservoir_refills_to_high_water_and_serves_each_bit_once():
+    reservoir = make_reservoir(high_water=100, low_water=40, refill_bits=30)
+    asyncio.run(reservoir.refill())
+    assert reservoir.depth == 100
+    assert reservoir.refill_rate > 0
+
+    alice_key, bob_key = reservoir.take(45)
+    assert alice_key == bob_key
+    assert str(alice_key) == "10" * 22 + "1"
+    assert reservoir.depth == 55
+    assert reservoir.take(56) is None
+    assert reservoir.take(55) is not None
+    assert reservoir.status()["served_bits"] == 100
+
+
+def test_reservoir_only_serves_matching_options():
+    reservoir = make_reservoir()
+    assert reservoir.matches({"backend": "analytic"})
+    assert not reservoir.matches({"backend": "aer"})
+    assert not make_reservoir(high_water=0).matches({"backend": "analytic"})
+
+
+def test_background_refill_tops_up_below_low_water():
+    async def scenario():
+        reservoir = make_reservoir(high_water=64, low_water=32, refill_bits=16)
+        reservoir.start()
+        while reservoir.depth < 64:
+            await asyncio.sleep(0)
+        reservoir.take(40)
+        while reservoir.depth < 64:
+            await asyncio.sleep(0)
+        await reservoir.stop()
+        return reservoir.status()
+
+    status = asyncio.run(scenario())
+    assert status["depth"] == 64
+    assert status["generated_bits"] == 104
@@ -0,0 +1,54 @@
+import asyncio
+import base64
+import json
+import os
+
+from worker_pool import PoolSaturated
+
+# Very long keys are produced round by round, so memory stays bounded by one round. Rounds are
+# kept short because a round already running on a worker finishes even after a disconnect.
+stream_round_bits = int(os.environ.get("QKD_STREAM_ROUND_BITS", 1 << 16))
+stream_max_bits = int(os.environ.get("QKD_STREAM_MAX_BITS", 1 << 30))
+stream_formats = ("binary", "ndjson")
+stream_parties = ("alice", "bob")
+stream_media_types = {"binary": "application/octet-stream", "ndjson": "application/x-ndjson"}
+stream_disconnect_poll = 0.1
+
+
+async def generate_key_rounds(worker_pool, protocol_function, desired_key_length, round_bits=None,
+                              is_disconnected=None, **options):
+    # Yields (alice_key, bob_key) per round. Rounds are a multiple of 8 bits, so every
+    # round but the last packs into whole bytes. is_disconnected() is polled while a round runs,
+    # a disconnect cancels the round, so a round still queued for a worker never starts.
+    round_bits = round_bits or stream_round_bits
+    round_bits = max(8, round_bits - round_bits % 8)
+    remaining = desired_key_length
+    while remaining > 0:
+        n_bits = min(round_bits, remaining)
+        round_task = asyncio.ensure_future(worker_pool.run(protocol_function, n_bits, **options))
+        try:
+            while is_disconnected is not None and not round_task.done():
+                if await is_disconnected():
+                    return
+                await asyncio.wait({round_task}, timeout=stream_disconnect_poll)
+            keys = await round_task
+        except PoolSaturated as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        finally:
+            round_task.cancel()
+        remaining -= n_bits
+        yield keys[0], keys[1]
+
+
+async def encode_key_rounds(rounds, format="binary", party="alice"):
+    # binary: the chosen party's packed key bytes, the last byte zero-padded
+    # ndjson: one line per round with both parties' keys in base64
+    async for alice_key, bob_key in rounds:
+        if format == "ndjson":
+            line = {"bits": len(alice_key),
+                    "alice_key": base64.b64encode(alice_key.to_bytes()).decode(),
+                    "bob_key": base64.b64encode(bob_key.to_bytes()).decode()}
+            yield (json.dumps(line) + "\n").encode()
+        else:
+            yield (alice_key if party == "alice" else bob_key).to_bytes()
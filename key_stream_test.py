@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+
+from fastapi.testclient import TestClient
+
+import key_stream
+from generate_bb84_key import bb84_qkd_protocol
+from generate_key import app
+from key_stream import encode_key_rounds, generate_key_rounds
+from qkd_key import QKDKey
+
+client = TestClient(app)
+
+
+class InlinePool:
+    async def run(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+async def collect(rounds):
+    return [keys async for keys in rounds]
+
+
+def test_rounds_are_byte_aligned_and_cover_the_requested_length():
+    rounds = asyncio.run(collect(generate_key_rounds(InlinePool(), bb84_qkd_protocol, 100, round_bits=30)))
+    assert [len(alice) for alice, _ in rounds] == [24, 24, 24, 24, 4]
+    assert all(alice == bob for alice, bob in rounds)
+
+
+def test_rounds_stop_after_disconnect():
+    calls = []
+
+    async def is_disconnected():
+        calls.append(1)
+        return len(calls) > 2
+
+    rounds = asyncio.run(collect(generate_key_rounds(InlinePool(), bb84_qkd_protocol, 1000, round_bits=64,
+                                                     is_disconnected=is_disconnected)))
+    assert len(rounds) == 2
+
+
+def test_disconnect_cancels_the_running_round():
+    cancelled = []
+
+    class SlowPool:
+        async def run(self, fn, *args, **kwargs):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(args)
+                raise
+
+    async def is_disconnected():
+        return bool(disconnected)
+
+    async def stream():
+        rounds = generate_key_rounds(SlowPool(), bb84_qkd_protocol, 1000, round_bits=64,
+                                     is_disconnected=is_disconnected)
+        asyncio.get_running_loop().call_later(0.2, disconnected.append, 1)
+        keys = await collect(rounds)
+        await asyncio.sleep(0)
+        return keys
+
+    disconnected = []
+    start = time.perf_counter()
+    assert asyncio.run(stream()) == []
+    assert time.perf_counter() - start < 5
+    assert cancelled == [(64,)]
+
+
+def test_ndjson_encoding_has_one_line_per_round():
+    async def rounds():
+        yield QKDKey.from_string("1" * 16), QKDKey.from_string("1" * 16)
+        yield QKDKey.from_string("101"), QKDKey.from_string("101")
+
+    async def encode():
+        return [chunk async for chunk in encode_key_rounds(rounds(), format="ndjson")]
+
+    lines = [json.loads(line) for line in asyncio.run(encode())]
+    assert [line["bits"] for line in lines] == [16, 3]
+    assert lines[0]["alice_key"] == "//8="
+
+
+def test_stream_endpoint_returns_packed_key_bytes(monkeypatch):
+    monkeypatch.setattr(key_stream, "stream_round_bits", 4096)
+    response = client.get("/bb84_key_stream/20000?backend=analytic")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert len(response.content) == 2500
+
+    response = client.get("/e91_key_stream/1000?format=ndjson&backend=analytic")
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sum(line["bits"] for line in lines) == 1000
+    assert all(line["alice_key"] == line["bob_key"] for line in lines)
+
+
+def test_stream_endpoint_validates_parameters():
+    assert client.get("/bs_key_stream/0").status_code == 400
+    assert client.get("/bs_key_stream/64?format=xml").status_code == 400
+    assert client.get("/bs_key_stream/64?party=eve").status_code == 400
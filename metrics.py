@@ -0,0 +1,127 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+# Per-stage timing histograms and counters in Prometheus text format. Pool workers record into
+# their own registry and WorkerPool.run merges it into the server's after every call.
+metrics_buckets = tuple(float(b) for b in os.environ.get(
+    "QKD_METRICS_BUCKETS", "0.0001,0.0005,0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,60").split(","))
+stages = ("circuit_build", "transpile", "simulate", "decode", "sift", "post_process")
+# Diagnostic output goes through logging, debug messages include per-pairing choices
+log_level = os.environ.get("QKD_LOG_LEVEL", "WARNING").upper()
+
+counter_help = {
+    "qkd_simulator_jobs_total": "Aer jobs submitted",
+    "qkd_simulator_circuits_total": "Circuits submitted to Aer",
+    "qkd_simulator_shots_total": "Shots run on Aer, over all circuits",
+    "qkd_template_cache_total": "Transpiled circuit template lookups by result",
+    "qkd_outcome_table_lookups_total": "BS pairings answered from the precomputed outcome table",
+    "qkd_key_pool_requests_total": "Key requests offered to a key reservoir, by protocol and result (hit, miss, bypass)",
+    "qkd_pool_rejected_total": "Requests refused because the worker pool was saturated",
+}
+gauge_help = {
+    "qkd_worker_pool_pending": "Requests running or queued on the worker pool",
+    "qkd_key_pool_bits": "Key bits held by a key reservoir, by protocol",
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+
+
+def configure_logging():
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+def observe(stage, seconds):
+    with _lock:
+        if stage not in _histograms:
+            _histograms[stage] = [np.zeros(len(metrics_buckets), dtype=np.int64), 0.0, 0]
+        histogram = _histograms[stage]
+        histogram[0][np.searchsorted(metrics_buckets, seconds):] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timed(stage):
+    # Usable as a with-block or as a function decorator
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def collect_metrics():
+    # Returns and clears what this process recorded, to be merged elsewhere
+    global _histograms, _counters
+    with _lock:
+        collected = (_histograms, _counters)
+        _histograms, _counters = {}, {}
+    return collected
+
+
+def merge_metrics(collected):
+    histograms, counters = collected
+    with _lock:
+        for stage, (buckets, total, n) in histograms.items():
+            if stage not in _histograms:
+                _histograms[stage] = [np.zeros(len(metrics_buckets), dtype=np.int64), 0.0, 0]
+            histogram = _histograms[stage]
+            histogram[0] += buckets
+            histogram[1] += total
+            histogram[2] += n
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+
+
+def run_with_metrics(fn, *args, **kwargs):
+    # Runs fn in a pool worker and returns its result with the metrics it recorded
+    result = fn(*args, **kwargs)
+    return result, collect_metrics()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def render_metrics():
+    lines = ["# HELP qkd_stage_seconds Time spent per key generation stage",
+             "# TYPE qkd_stage_seconds histogram"]
+    with _lock:
+        for stage in [s for s in stages if s in _histograms] + sorted(set(_histograms) - set(stages)):
+            buckets, total, n = _histograms[stage]
+            for bound, value in zip(metrics_buckets, buckets):
+                lines.append(f'qkd_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {value}')
+            lines.append(f'qkd_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {n}')
+            lines.append(f'qkd_stage_seconds_sum{{stage="{stage}"}} {total:.9g}')
+            lines.append(f'qkd_stage_seconds_count{{stage="{stage}"}} {n}')
+        for kind, help_texts, values in (("counter", counter_help, _counters), ("gauge", gauge_help, _gauges)):
+            for name, help_text in help_texts.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                samples = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+                if not samples and kind == "counter":
+                    samples = [((), 0)]
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {value:.12g}")
+    return "\n".join(lines) + "\n"
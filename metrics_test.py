@@ -0,0 +1,31 @@
+import time
+
+from metrics import collect_metrics, count, merge_metrics, metrics_buckets, render_metrics, timed
+
+
+def test_stage_histogram_is_cumulative():
+    collect_metrics()
+    with timed("sift"):
+        pass
+    with timed("sift"):
+        time.sleep(metrics_buckets[0] * 2)
+    histograms, _ = collect_metrics()
+    buckets, total, n = histograms["sift"]
+    assert n == 2 and total >= metrics_buckets[0] * 2
+    assert buckets[0] == 1 and buckets[-1] == 2 and all(buckets[1:] >= buckets[:-1])
+
+
+def test_collected_metrics_merge_into_the_registry():
+    collect_metrics()
+    count("qkd_simulator_jobs_total", 3)
+    with timed("decode"):
+        pass
+    collected = collect_metrics()
+    assert "qkd_simulator_jobs_total 0" in render_metrics()
+
+    merge_metrics(collected)
+    merge_metrics(collected)
+    text = render_metrics()
+    assert "qkd_simulator_jobs_total 6" in text
+    assert 'qkd_stage_seconds_count{stage="decode"} 2' in text
+    assert 'qkd_stage_seconds_bucket{stage="decode",le="+Inf"} 2' in text
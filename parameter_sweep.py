@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from worker_pool import pool_start_method, pool_workers, warm_worker
+
+# A sweep point is one protocol run with these parameters. Results are stored as columns
+# in an npz file, one row per point, keyed by a hash of the point's parameters.
+sweep_parameters = ("protocol", "key_length", "backend", "depolarizing", "bit_flip", "loss", "interception",
+                    "repeat")
+sweep_results = ("raw_count", "sifted_bits", "yield", "qber", "chsh", "wall_time")
+sweep_defaults = {"protocol": ["BB84"], "key_length": [1024], "backend": ["analytic"], "depolarizing": [0.0],
+                  "bit_flip": [0.0], "loss": [0.0], "interception": [0.0], "repeat": [0]}
+sweep_protocols = ("BS", "BB84", "E91")
+noise_parameters = ("depolarizing", "bit_flip", "loss", "interception")
+
+
+def point_hash(point):
+    return hashlib.sha256(json.dumps(point, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def point_seed(point):
+    # Every point gets its own seed, so results do not depend on the grid or on the worker
+    return int(point_hash(point), 16) % 2 ** 32
+
+
+def expand_grid(grid):
+    # grid maps parameter names to lists of values, missing parameters use sweep_defaults.
+    # The BS protocol has no channel model, so noisy BS points are left out, and points with
+    # loss 1 never sift a key.
+    unknown = set(grid) - set(sweep_parameters)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(sorted(unknown))}")
+    values = [list(grid.get(name, sweep_defaults[name])) for name in sweep_parameters]
+    points = []
+    for combination in itertools.product(*values):
+        point = dict(zip(sweep_parameters, combination))
+        # 0 and 0.0 must hash the same
+        point.update({name: float(point[name]) for name in noise_parameters})
+        point.update(key_length=int(point["key_length"]), repeat=int(point["repeat"]))
+        if point["protocol"] not in sweep_protocols:
+            raise ValueError(f"Protocol must be one of {', '.join(sweep_protocols)}")
+        if point["protocol"] == "BS" and any(point[name] for name in noise_parameters):
+            continue
+        if point["loss"] == 1:
+            continue
+        points.append(point)
+    return points
+
+
+def run_point(point):
+    from channel_model import ChannelModel
+    from generate_bb84_key import bb84_qkd_protocol
+    from generate_bs_key import bs_qkd_protocol
+    from generate_e91_key import e91_qkd_protocol
+
+    rng = np.random.default_rng(point_seed(point))
+
+    start = time.perf_counter()
+    if point["protocol"] == "BS":
+        alice_key, bob_key, statistics = bs_qkd_protocol(point["key_length"], backend=point["backend"],
+                                                         return_statistics=True, rng=rng)
+        raw_count = statistics["pairings"]
+    else:
+        channel = ChannelModel(*(point[name] for name in noise_parameters))
+        protocol_function = bb84_qkd_protocol if point["protocol"] == "BB84" else e91_qkd_protocol
+        alice_key, bob_key, statistics = protocol_function(point["key_length"], backend=point["backend"],
+                                                           channel=channel, return_statistics=True, rng=rng)
+        raw_count = statistics["qubits"] if point["protocol"] == "BB84" else statistics["singlets"]
+    wall_time = time.perf_counter() - start
+
+    return {
+        "raw_count": raw_count,
+        "sifted_bits": statistics["sifted_bits"],
+        "yield": statistics["sifted_bits"] / raw_count,
+        "qber": alice_key.hamming_distance(bob_key) / len(alice_key),
+        "chsh": np.nan if statistics.get("chsh") is None else statistics["chsh"],
+        "wall_time": wall_time,
+    }
+
+
+def load_results(path):
+    # Columns of a previous sweep, or empty columns when there is none
+    if path is None or not os.path.exists(path):
+        return to_columns([])
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save_results(path, columns):
+    # Written next to the target and renamed, so an interrupted sweep never leaves a broken file
+    temporary = path + ".tmp.npz"
+    np.savez_compressed(temporary, **columns)
+    os.replace(temporary, path)
+
+
+def to_columns(rows):
+    columns = {}
+    for name in ("hash",) + sweep_parameters + sweep_results:
+        values = [row[name] for row in rows]
+        columns[name] = np.array(values, dtype=str if name in ("hash", "protocol", "backend") else float)
+    return columns
+
+
+def run_sweep(grid, path=None, max_workers=pool_workers):
+    # Computes the points of grid that are not in the file at path yet and returns all
+    # columns of the grid's points, in grid order
+    points = expand_grid(grid)
+    stored = load_results(path)
+    stored_rows = {h: i for i, h in enumerate(stored["hash"])}
+    missing = [point for point in points if point_hash(point) not in stored_rows]
+
+    computed = {}
+    if missing:
+        from app_functions import get_outcome_table
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(pool_start_method),
+                                 initializer=warm_worker, initargs=(get_outcome_table(),)) as executor:
+            for point, result in zip(missing, executor.map(run_point, missing)):
+                computed[point_hash(point)] = {"hash": point_hash(point), **point, **result}
+
+    if computed and path is not None:
+        new = to_columns(list(computed.values()))
+        save_results(path, {name: np.concatenate([stored[name], new[name]]) for name in new})
+
+    rows = []
+    for point in points:
+        h = point_hash(point)
+        if h in computed:
+            rows.append(computed[h])
+        else:
+            i = stored_rows[h]
+            rows.append({name: stored[name][i] for name in ("hash",) + sweep_parameters + sweep_results})
+    return to_columns(rows), len(computed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep QKD protocols over key lengths and channel noise")
+    parser.add_argument("--protocol", nargs="+", default=sweep_defaults["protocol"], choices=sweep_protocols)
+    parser.add_argument("--key-length", nargs="+", type=int, default=sweep_defaults["key_length"])
+    parser.add_argument("--backend", nargs="+", default=sweep_defaults["backend"], choices=("aer", "analytic"))
+    for name in noise_parameters:
+        parser.add_argument("--" + name.replace("_", "-"), nargs="+", type=float, default=sweep_defaults[name])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", default="sweep.npz")
+    parser.add_argument("--workers", type=int, default=pool_workers)
+    args = parser.parse_args(argv)
+
+    grid = {"protocol": args.protocol, "key_length": args.key_length, "backend": args.backend,
+            "repeat": list(range(args.repeats))}
+    grid.update({name: getattr(args, name) for name in noise_parameters})
+    columns, computed = run_sweep(grid, args.output, max_workers=args.workers)
+
+    print(f"{len(columns['hash'])} points, {computed} computed, results in {args.output}")
+    print("protocol key_length backend depolarizing bit_flip loss interception yield qber chsh wall_time")
+    for i in range(len(columns["hash"])):
+        print(columns["protocol"][i], int(columns["key_length"][i]), columns["backend"][i],
+              *(columns[name][i] for name in noise_parameters),
+              *(f"{columns[name][i]:.4f}" for name in ("yield", "qber", "chsh", "wall_time")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+
+from parameter_sweep import expand_grid, point_hash, run_sweep
+
+
+def test_noisy_bs_points_are_skipped():
+    points = expand_grid({"protocol": ["BS", "BB84"], "depolarizing": [0, 0.1]})
+    assert [(p["protocol"], p["depolarizing"]) for p in points] == [("BS", 0.0), ("BB84", 0.0), ("BB84", 0.1)]
+
+
+def test_points_without_detections_are_skipped():
+    points = expand_grid({"protocol": ["BB84", "E91"], "loss": [0.5, 1]})
+    assert [(p["protocol"], p["loss"]) for p in points] == [("BB84", 0.5), ("E91", 0.5)]
+
+
+def test_point_hash_ignores_number_types():
+    assert point_hash(expand_grid({"loss": [0]})[0]) == point_hash(expand_grid({"loss": [0.0]})[0])
+
+
+def test_rerun_only_computes_missing_points(tmp_path):
+    path = str(tmp_path / "sweep.npz")
+    grid = {"protocol": ["BB84", "E91"], "key_length": [256], "interception": [0, 1]}
+    columns, computed = run_sweep(grid, path, max_workers=2)
+    assert computed == 4
+    assert np.all(columns["qber"][columns["interception"] == 0] == 0)
+    assert np.all(columns["qber"][columns["interception"] == 1] > 0)
+    assert np.all(columns["yield"] > 0)
+
+    grid["key_length"] = [256, 512]
+    columns_again, computed = run_sweep(grid, path, max_workers=2)
+    assert computed == 4
+    assert len(columns_again["hash"]) == 8
+    assert np.array_equal(columns_again["qber"][:2], columns["qber"][:2])
+
+
+def test_extending_with_shorter_strings_keeps_stored_ones(tmp_path):
+    path = str(tmp_path / "sweep.npz")
+    run_sweep({"protocol": ["BB84"], "key_length": [64], "backend": ["analytic"]}, path, max_workers=1)
+    run_sweep({"protocol": ["BS"], "key_length": [64], "backend": ["analytic"]}, path, max_workers=1)
+    columns, computed = run_sweep({"protocol": ["BB84", "BS"], "key_length": [64], "backend": ["analytic"]}, path,
+                                  max_workers=1)
+    assert computed == 0
+    assert list(columns["protocol"]) == ["BB84", "BS"]
@@ -0,0 +1,195 @@
+import math
+import time
+
+import numpy as np
+
+from metrics import timed
+from qkd_key import QKDKey
+from randomness import get_rng
+
+# Cascade reconciliation: the first block size follows the usual 0.73 / QBER rule and
+# doubles on every pass, each pass after the first works on a public random permutation
+cascade_passes = 4
+cascade_min_qber = 0.01
+
+# Bits disclosed to estimate the QBER when it is not given, discarded afterwards
+qber_sample_fraction = 0.1
+qber_sample_bits = 1024
+
+# Reconciliation is verified by comparing a Toeplitz hash of both keys under a public random
+# seed. On a mismatch Cascade runs again with smaller blocks, after the last retry the block
+# is discarded. The hash bits count as leaked.
+verification_hash_bits = 64
+verification_retries = 3
+
+# Extra bits removed by privacy amplification on top of the leaked and eavesdropper bits
+pa_security_bits = 64
+
+# Raw key requested per final key bit by post_processed_protocol, grown while it falls short
+post_processing_margin = 1.25
+# post_processed_protocol gives up after this many rounds, or at once when the QBER leaves no
+# secret key: reconciliation and privacy amplification each remove about n * h(QBER) bits
+post_processing_max_attempts = 10
+
+
+def binary_entropy(p):
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
+
+
+def prefix_parity(bits):
+    # parity of bits[a:b] is prefix[b] ^ prefix[a]
+    return np.concatenate(([0], np.bitwise_xor.accumulate(bits))).astype(np.uint8)
+
+
+def locate_errors(permutation, starts, ends, alice_prefix, bob_bits):
+    # Binary search of every odd-parity block at once, returns the error positions
+    # and the number of sub-block parities Alice had to disclose
+    bob_prefix = prefix_parity(bob_bits[permutation])
+    mismatched = (alice_prefix[ends] ^ alice_prefix[starts]) != (bob_prefix[ends] ^ bob_prefix[starts])
+    lo, hi = starts[mismatched], ends[mismatched]
+    leaked = 0
+    while True:
+        active = hi - lo > 1
+        if not active.any():
+            break
+        mid = (lo + hi) // 2
+        left = (alice_prefix[mid] ^ alice_prefix[lo]) != (bob_prefix[mid] ^ bob_prefix[lo])
+        leaked += int(np.count_nonzero(active))
+        hi = np.where(active & left, mid, hi)
+        lo = np.where(active & ~left, mid, lo)
+    return permutation[lo], leaked
+
+
+def cascade_reconcile(alice_bits, bob_bits, qber, passes=cascade_passes, rng=None):
+    # Returns Bob's corrected bits, the bits leaked to an eavesdropper and the bits flipped
+    rng = rng or get_rng()
+    n = len(alice_bits)
+    bob_bits = np.array(bob_bits, dtype=np.uint8)
+    if n == 0:
+        return bob_bits, 0, 0
+
+    block_size = int(np.clip(math.ceil(0.73 / max(qber, cascade_min_qber)), 2, n))
+    layouts = []
+    leaked = corrected = 0
+    for i in range(passes):
+        permutation = np.arange(n) if i == 0 else rng.permutation(n)
+        starts = np.arange(0, n, min(block_size << i, n))
+        ends = np.minimum(starts + min(block_size << i, n), n)
+        # Alice discloses one parity per block of the pass
+        layouts.append((permutation, starts, ends, prefix_parity(alice_bits[permutation])))
+        leaked += len(starts)
+
+        # Every flip changes the parity of one block in each earlier pass, so passes are
+        # revisited until all disclosed parities agree
+        changed = True
+        while changed:
+            changed = False
+            for layout in reversed(layouts):
+                errors, search_leaked = locate_errors(*layout, bob_bits)
+                if len(errors):
+                    bob_bits[errors] ^= 1
+                    leaked += search_leaked
+                    corrected += len(errors)
+                    changed = True
+    return bob_bits, leaked, corrected
+
+
+def toeplitz_hash(bits, output_length, seed_bits):
+    # seed_bits holds len(bits) + output_length - 1 bits and defines the Toeplitz matrix
+    # T[i, j] = seed_bits[i - j + len(bits) - 1], T @ bits is computed as an FFT convolution
+    n = len(bits)
+    if output_length <= 0 or n == 0:
+        return np.zeros(0, dtype=np.uint8)
+    size = 1 << (n + len(seed_bits) - 2).bit_length()
+    convolution = np.fft.irfft(np.fft.rfft(seed_bits, size) * np.fft.rfft(bits, size), size)
+    return (np.rint(convolution[n - 1:n - 1 + output_length]).astype(np.int64) & 1).astype(np.uint8)
+
+
+def keys_match(alice_bits, bob_bits, rng):
+    seed_bits = rng.integers(0, 2, size=len(alice_bits) + verification_hash_bits - 1, dtype=np.uint8)
+    return np.array_equal(toeplitz_hash(alice_bits, verification_hash_bits, seed_bits),
+                          toeplitz_hash(bob_bits, verification_hash_bits, seed_bits))
+
+
+def estimate_qber(alice_bits, bob_bits, rng):
+    # Compares a random sample of the key in public and drops it from both keys
+    n = len(alice_bits)
+    sample = rng.choice(n, min(qber_sample_bits, int(n * qber_sample_fraction)), replace=False)
+    qber = float(np.mean(alice_bits[sample] != bob_bits[sample])) if len(sample) else 0.0
+    keep = np.ones(n, dtype=bool)
+    keep[sample] = False
+    return qber, len(sample), alice_bits[keep], bob_bits[keep]
+
+
+@timed("post_process")
+def post_process(alice_key, bob_key, qber=None, rng=None):
+    # Cascade reconciliation followed by Toeplitz-hash privacy amplification.
+    # Returns the final keys and the post-processing statistics.
+    rng = rng or get_rng()
+    start = time.perf_counter()
+    alice_bits, bob_bits = alice_key.to_bits(), bob_key.to_bits()
+    raw_bits = len(alice_bits)
+
+    sampled_bits = 0
+    if qber is None:
+        qber, sampled_bits, alice_bits, bob_bits = estimate_qber(alice_bits, bob_bits, rng)
+    bob_bits, leaked, corrected = cascade_reconcile(alice_bits, bob_bits, qber, rng=rng)
+    verified = keys_match(alice_bits, bob_bits, rng)
+    leaked += verification_hash_bits
+    retries = 0
+    reconcile_qber = max(qber, cascade_min_qber)
+    while not verified and retries < verification_retries:
+        reconcile_qber = min(0.5, 2 * reconcile_qber)
+        bob_bits, retry_leaked, retry_corrected = cascade_reconcile(alice_bits, bob_bits, reconcile_qber, rng=rng)
+        verified = keys_match(alice_bits, bob_bits, rng)
+        leaked += retry_leaked + verification_hash_bits
+        corrected += retry_corrected
+        retries += 1
+    residual_errors = int(np.count_nonzero(alice_bits != bob_bits))
+    reconciled = time.perf_counter()
+
+    n = len(alice_bits)
+    final_length = max(0, n - leaked - math.ceil(n * binary_entropy(qber)) - pa_security_bits)
+    # The simulation holds both keys, so even a hash collision never yields unequal keys
+    if not verified or residual_errors:
+        final_length = 0
+    seed_bits = rng.integers(0, 2, size=n + final_length - 1, dtype=np.uint8) if final_length else None
+    alice_final = QKDKey.from_bits(toeplitz_hash(alice_bits, final_length, seed_bits))
+    bob_final = QKDKey.from_bits(toeplitz_hash(bob_bits, final_length, seed_bits))
+    end = time.perf_counter()
+
+    statistics = {
+        "raw_bits": raw_bits,
+        "qber": qber,
+        "sampled_bits": sampled_bits,
+        "leaked_bits": leaked,
+        "corrected_bits": corrected,
+        "verified": verified and not residual_errors,
+        "verification_retries": retries,
+        "residual_errors": residual_errors,
+        "final_bits": final_length,
+        "reconciliation_time": reconciled - start,
+        "amplification_time": end - reconciled,
+        "throughput": raw_bits / max(end - start, 1e-9),
+    }
+    return alice_final, bob_final, statistics
+
+
+def post_processed_protocol(protocol_function, desired_key_length, rng=None, **options):
+    # Runs a protocol for enough raw key that at least desired_key_length bits are left after
+    # post-processing. Protocol statistics (E91) are merged into the returned statistics.
+    rng = rng or get_rng()
+    raw_length = math.ceil((desired_key_length + pa_security_bits) * post_processing_margin)
+    for _ in range(post_processing_max_attempts):
+        generated = protocol_function(raw_length, rng=rng, **options)
+        alice_key, bob_key, statistics = post_process(generated[0], generated[1], rng=rng)
+        if len(generated) > 2:
+            statistics.update(generated[2])
+        if len(alice_key) >= desired_key_length:
+            return alice_key[:desired_key_length], bob_key[:desired_key_length], statistics
+        if 2 * binary_entropy(statistics["qber"]) >= 1:
+            raise ValueError(f"QBER {statistics['qber']:.3f} is too high to extract a secret key")
+        raw_length = math.ceil(raw_length * post_processing_margin)
+    raise ValueError(f"No {desired_key_length}-bit key after {post_processing_max_attempts} post-processing rounds")
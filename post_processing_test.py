@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from post_processing import (binary_entropy, cascade_reconcile, post_process, post_processed_protocol,
+                             toeplitz_hash)
+from qkd_key import QKDKey
+
+
+def noisy_keys(n, qber, seed):
+    rng = np.random.default_rng(seed)
+    alice = rng.integers(0, 2, n, dtype=np.uint8)
+    bob = alice.copy()
+    bob[rng.random(n) < qber] ^= 1
+    return alice, bob
+
+
+def test_toeplitz_hash_matches_matrix_product():
+    rng = np.random.default_rng(0)
+    bits = rng.integers(0, 2, 61, dtype=np.uint8)
+    seed_bits = rng.integers(0, 2, 61 + 23 - 1, dtype=np.uint8)
+    matrix = np.array([[seed_bits[i - j + 60] for j in range(61)] for i in range(23)])
+    assert np.array_equal(toeplitz_hash(bits, 23, seed_bits), matrix @ bits % 2)
+
+
+def test_cascade_corrects_errors():
+    alice, bob = noisy_keys(20000, 0.04, seed=1)
+    corrected, leaked, flipped = cascade_reconcile(alice, bob, 0.04, rng=np.random.default_rng(1))
+    assert np.array_equal(corrected, alice)
+    assert flipped == np.count_nonzero(alice != bob)
+    # Cascade leaks somewhat more than the Shannon limit
+    assert 20000 * binary_entropy(0.04) < leaked < 1.5 * 20000 * binary_entropy(0.04)
+
+
+def test_post_process_gives_equal_shorter_keys():
+    alice, bob = noisy_keys(8000, 0.02, seed=2)
+    alice_key, bob_key, statistics = post_process(QKDKey.from_bits(alice), QKDKey.from_bits(bob),
+                                                  rng=np.random.default_rng(2))
+    assert alice_key == bob_key
+    assert statistics["verified"] and statistics["residual_errors"] == 0
+    assert len(alice_key) == statistics["final_bits"] < 8000 - statistics["leaked_bits"]
+    assert statistics["throughput"] > 0
+
+
+def test_post_processed_protocol_reaches_requested_length():
+    def protocol(n_bits, rng):
+        alice, bob = noisy_keys(n_bits, 0.03, seed=n_bits)
+        return QKDKey.from_bits(alice), QKDKey.from_bits(bob), {"chsh": -2.8}
+
+    alice_key, bob_key, statistics = post_processed_protocol(protocol, 500)
+    assert len(alice_key) == 500 and alice_key == bob_key
+    assert statistics["chsh"] == -2.8
+
+
+def test_unverified_reconciliation_is_discarded(monkeypatch):
+    import post_processing
+    # Reconciliation that corrects nothing never passes the hash comparison
+    monkeypatch.setattr(post_processing, "cascade_reconcile", lambda alice, bob, qber, rng: (bob, 0, 0))
+    alice, bob = noisy_keys(8000, 0.02, seed=3)
+    alice_key, bob_key, statistics = post_process(QKDKey.from_bits(alice), QKDKey.from_bits(bob), qber=0.02,
+                                                  rng=np.random.default_rng(3))
+    assert len(alice_key) == len(bob_key) == 0
+    assert not statistics["verified"] and statistics["residual_errors"] > 0
+    assert statistics["verification_retries"] == post_processing.verification_retries
+    hash_bits = (post_processing.verification_retries + 1) * post_processing.verification_hash_bits
+    assert statistics["leaked_bits"] == hash_bits
+
+
+def test_post_processed_keys_are_equal_for_every_seed():
+    def protocol(n_bits, rng):
+        alice, bob = noisy_keys(n_bits, 0.03, seed=int(rng.integers(1 << 31)))
+        return QKDKey.from_bits(alice), QKDKey.from_bits(bob)
+
+    for seed in range(300):
+        alice_key, bob_key, statistics = post_processed_protocol(protocol, 500, rng=np.random.default_rng(seed))
+        assert len(alice_key) == 500 and alice_key == bob_key
+        assert statistics["residual_errors"] == 0
+
+
+def test_post_processed_protocol_gives_up_on_a_high_qber():
+    def protocol(n_bits, rng):
+        alice, bob = noisy_keys(n_bits, 0.2, seed=int(rng.integers(1 << 31)))
+        return QKDKey.from_bits(alice), QKDKey.from_bits(bob)
+
+    with pytest.raises(ValueError, match="too high"):
+        post_processed_protocol(protocol, 64)
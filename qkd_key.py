@@ -0,0 +1,85 @@
+import numpy as np
+
+# Number of set bits for every byte value, used for Hamming distances
+_popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class QKDKey:
+    # Key material shared by all protocols: bits packed 8 per byte, most significant bit
+    # first, with the unused bits of the last byte kept at zero
+    __slots__ = ("_packed", "_length")
+
+    def __init__(self, packed=None, length=0):
+        self._packed = np.zeros(0, dtype=np.uint8) if packed is None else packed
+        self._length = length
+
+    @classmethod
+    def from_bits(cls, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        return cls(np.packbits(bits), len(bits))
+
+    @classmethod
+    def from_string(cls, bits):
+        return cls.from_bits(np.frombuffer(bits.encode(), dtype=np.uint8) - ord("0"))
+
+    @classmethod
+    def from_bytes(cls, data, length=None):
+        packed = np.frombuffer(data, dtype=np.uint8).copy()
+        key = cls(packed, 8 * len(packed))
+        return key if length is None else key[:length]
+
+    @classmethod
+    def concatenate(cls, keys):
+        keys = [key for key in keys if len(key)]
+        if not keys:
+            return cls()
+        if all(len(key) % 8 == 0 for key in keys[:-1]):
+            # Byte-aligned pieces are joined without unpacking
+            return cls(np.concatenate([key._packed for key in keys]), sum(len(key) for key in keys))
+        return cls.from_bits(np.concatenate([key.to_bits() for key in keys]))
+
+    def to_bits(self):
+        return np.unpackbits(self._packed, count=self._length)
+
+    def to_bytes(self):
+        return self._packed.tobytes()
+
+    def hamming_distance(self, other):
+        return int(_popcount[(self ^ other)._packed].sum(dtype=np.int64))
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._length)
+            stop = max(start, stop)
+            if step == 1 and start % 8 == 0:
+                packed = self._packed[start // 8:(stop + 7) // 8].copy()
+                if stop % 8 and len(packed):
+                    packed[-1] &= 0xFF << (8 - stop % 8) & 0xFF
+                return QKDKey(packed, stop - start)
+            return QKDKey.from_bits(self.to_bits()[item])
+        return int(self.to_bits()[item])
+
+    def __add__(self, other):
+        return QKDKey.concatenate([self, other])
+
+    def __xor__(self, other):
+        if len(self) != len(other):
+            raise ValueError("Keys must have the same length")
+        return QKDKey(np.bitwise_xor(self._packed, other._packed), self._length)
+
+    def __eq__(self, other):
+        if not isinstance(other, QKDKey):
+            return NotImplemented
+        return self._length == other._length and np.array_equal(self._packed, other._packed)
+
+    __hash__ = None
+
+    def __str__(self):
+        return (self.to_bits() + ord("0")).tobytes().decode()
+
+    def __repr__(self):
+        # Never print the key material itself
+        return f"QKDKey({self._length} bits)"
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from qkd_key import QKDKey
+
+
+def test_round_trips_between_strings_bits_and_bytes():
+    key = QKDKey.from_string("1011001110001")
+    assert str(key) == "1011001110001"
+    assert len(key) == 13
+    assert key.to_bits().tolist() == [1, 0, 1, 1, 0, 0, 1, 1, 1, 0, 0, 0, 1]
+    assert QKDKey.from_bytes(key.to_bytes(), 13) == key
+    assert repr(key) == "QKDKey(13 bits)"
+
+
+def test_concatenation_and_slicing_match_string_operations():
+    rng = np.random.default_rng(5)
+    pieces = [rng.integers(2, size=n) for n in (16, 5, 11, 0, 24)]
+    strings = ["".join(map(str, piece)) for piece in pieces]
+    key = QKDKey.concatenate(QKDKey.from_bits(piece) for piece in pieces)
+    joined = "".join(strings)
+    assert str(key) == joined
+    for item in (slice(None, 30), slice(8, 27), slice(3, 19), slice(None, None, 2), slice(40, 100)):
+        assert str(key[item]) == joined[item]
+    assert str(key[:16] + key[16:]) == joined
+    assert key[3] == int(joined[3])
+
+
+def test_xor_and_hamming_distance():
+    a = QKDKey.from_string("110010101")
+    b = QKDKey.from_string("100011100")
+    assert str(a ^ b) == "010001001"
+    assert a.hamming_distance(b) == 3
+    assert a.hamming_distance(a) == 0
+    with pytest.raises(ValueError):
+        a ^ b[:4]
+
+
+def test_slices_keep_padding_zeroed_for_equality():
+    key = QKDKey.from_string("11111111")
+    assert key[:3] == QKDKey.from_string("111")
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+# Every protocol draws from a numpy Generator passed as rng, or from this process's default
+# generator. QKD_SEED makes the default reproducible, QKD_SECURE_RANDOM=1 makes it draw from
+# the operating system's CSPRNG for production basis choices.
+random_seed = int(os.environ["QKD_SEED"]) if os.environ.get("QKD_SEED") else None
+secure_random = os.environ.get("QKD_SECURE_RANDOM", "0") == "1"
+
+_default_rng = None
+
+
+class SecureRandom:
+    # The part of the numpy.random.Generator API the protocols use, backed by os.urandom
+    def _uint64(self, n):
+        return np.frombuffer(os.urandom(8 * n), dtype=np.uint64)
+
+    def integers(self, low, high=None, size=None, dtype=np.int64):
+        if high is None:
+            low, high = 0, low
+        span = int(high) - int(low)
+        n = 1 if size is None else int(np.prod(size))
+        # Rejection sampling keeps every value equally likely
+        limit = np.uint64(2 ** 64 - 2 ** 64 % span) if 2 ** 64 % span else None
+        values = np.zeros(0, dtype=np.uint64)
+        while len(values) < n:
+            draw = self._uint64(n - len(values) + 8)
+            values = np.concatenate([values, draw if limit is None else draw[draw < limit]])
+        values = (values[:n] % np.uint64(span)).astype(np.int64) + int(low)
+        return int(values[0]) if size is None else values.astype(dtype).reshape(size)
+
+    def random(self, size=None):
+        n = 1 if size is None else int(np.prod(size))
+        values = (self._uint64(n) >> np.uint64(11)) * 2.0 ** -53
+        return float(values[0]) if size is None else values.reshape(size)
+
+    def permutation(self, n):
+        return np.argsort(self._uint64(n), kind="stable")
+
+    def choice(self, a, size=None, replace=True):
+        if replace:
+            return self.integers(a, size=size)
+        return self.permutation(a)[:size]
+
+
+def make_rng(seed=None, secure=False):
+    # secure ignores seed, a CSPRNG stream cannot be replayed
+    return SecureRandom() if secure else np.random.default_rng(seed)
+
+
+def spawn_rngs(seed, n):
+    # n statistically independent generators derived from one seed, e.g. one per pool worker
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(n)]
+
+
+def get_rng():
+    global _default_rng
+    if _default_rng is None:
+        _default_rng = make_rng(random_seed, secure_random)
+    return _default_rng
+
+
+def set_rng(rng):
+    global _default_rng
+    _default_rng = rng
+
+
+def simulator_seed(rng, seed_simulator=None, round_index=0):
+    # Aer seed for one simulator job: an explicit seed_simulator offset by the round,
+    # otherwise drawn from the protocol's generator so a seeded rng also fixes Aer
+    if seed_simulator is not None:
+        return seed_simulator + round_index
+    return int(rng.integers(2 ** 31))
+
+
+def seed_worker(seed):
+    # Pool workers derive their own stream from the server's seed and their process id,
+    # so no two workers replay the same draws
+    if secure_random:
+        set_rng(SecureRandom())
+    elif seed is not None:
+        set_rng(np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(os.getpid(),))))
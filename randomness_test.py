@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from app_functions import pairings_to_indices
+from channel_model import ChannelModel
+from generate_bb84_key import bb84_qkd_protocol
+from generate_bs_key import bs_qkd_protocol
+from generate_e91_key import e91_qkd_protocol
+from randomness import SecureRandom, spawn_rngs
+
+
+@pytest.mark.parametrize("protocol, options", [
+    (bs_qkd_protocol, {"backend": "aer"}),
+    (bs_qkd_protocol, {"backend": "analytic"}),
+    (bb84_qkd_protocol, {"backend": "aer", "channel": ChannelModel(depolarizing=0.05, interception=0.2)}),
+    (bb84_qkd_protocol, {"backend": "analytic"}),
+    (e91_qkd_protocol, {"backend": "aer"}),
+    (e91_qkd_protocol, {"backend": "analytic", "channel": ChannelModel(bit_flip=0.05, loss=0.1)}),
+])
+def test_same_seed_gives_same_keys(protocol, options):
+    first = protocol(256, rng=np.random.default_rng(7), **options)
+    second = protocol(256, rng=np.random.default_rng(7), **options)
+    other = protocol(256, rng=np.random.default_rng(8), **options)
+    assert first[0] == second[0] and first[1] == second[1]
+    assert first[0] != other[0]
+
+
+def test_spawned_streams_differ():
+    first, second = spawn_rngs(3, 2)
+    assert not np.array_equal(first.integers(2, size=256), second.integers(2, size=256))
+    assert np.array_equal(spawn_rngs(3, 2)[1].integers(2, size=256), spawn_rngs(3, 2)[1].integers(2, size=256))
+
+
+def test_secure_random_draws():
+    rng = SecureRandom()
+    values = rng.integers(1, 4, size=30000)
+    assert values.min() == 1 and values.max() == 3
+    assert np.allclose(np.bincount(values)[1:] / len(values), 1 / 3, atol=0.02)
+    assert sorted(rng.permutation(100)) == list(range(100))
+    alice_key, bob_key = bb84_qkd_protocol(256, rng=rng)
+    assert len(alice_key) == 256 and alice_key == bob_key
+
+
+def test_unknown_pairing_is_rejected():
+    assert pairings_to_indices([[[0, 2], [1, 3]], [[0, 1], [2, 3]]]).tolist() == [1, 0]
+    with pytest.raises(ValueError):
+        pairings_to_indices([[[0, 2], [3, 1]]])
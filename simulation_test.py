@@ -0,0 +1,36 @@
+from qiskit import QuantumCircuit
+
+from simulation import get_simulator, get_template, run_circuits, template_count
+
+
+def bell_circuit():
+    qc = QuantumCircuit(2, 2)
+    qc.h(0)
+    qc.cx(0, 1)
+    qc.measure([0, 1], [0, 1])
+    return qc
+
+
+def test_simulator_is_shared():
+    assert get_simulator() is get_simulator()
+    assert get_simulator("stabilizer") is not get_simulator()
+
+
+def test_template_is_transpiled_once():
+    builds = []
+
+    def build():
+        builds.append(1)
+        return bell_circuit()
+
+    first = get_template(("test", "bell"), build)
+    count = template_count()
+    assert get_template(("test", "bell"), build) is first
+    assert len(builds) == 1 and template_count() == count
+
+
+def test_run_circuits_reuses_template():
+    template = get_template(("test", "bell"), bell_circuit)
+    result = run_circuits([template, template], shots=64)
+    for i in range(2):
+        assert set(result.get_counts(i)) <= {"00", "11"}
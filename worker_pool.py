@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import configure_logging, count, merge_metrics, run_with_metrics
+
+# Key generation is CPU-bound, so it runs in worker processes instead of the event loop.
+# The pool size and the number of requests allowed to wait for a worker are configurable.
+pool_workers = int(os.environ.get("QKD_POOL_WORKERS", os.cpu_count() or 1))
+pool_max_pending = int(os.environ.get("QKD_POOL_MAX_PENDING", 4 * pool_workers))
+pool_retry_after = int(os.environ.get("QKD_POOL_RETRY_AFTER", 1))
+# Aer runs OpenMP threads, forking after a simulation can deadlock the child
+pool_start_method = os.environ.get("QKD_POOL_START_METHOD", "spawn")
+
+
+class PoolSaturated(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Key generation pool is saturated")
+        self.retry_after = retry_after
+
+
+def warm_worker(outcome_table, seed=None):
+    # Workers receive the BS outcome table from the server instead of simulating it again,
+    # and draw from their own random stream
+    from app_functions import set_outcome_table
+    from randomness import seed_worker
+    configure_logging()
+    set_outcome_table(outcome_table)
+    seed_worker(seed)
+
+
+class WorkerPool:
+    def __init__(self, max_workers=pool_workers, max_pending=pool_max_pending, retry_after=pool_retry_after):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self._executor = None
+
+    def start(self):
+        if self._executor is None:
+            from app_functions import get_outcome_table
+            from randomness import random_seed
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context(pool_start_method),
+                                                 initializer=warm_worker, initargs=(get_outcome_table(), random_seed))
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def submit(self, fn, *args, **kwargs):
+        # For blocking callers such as the Streamlit app: a future of fn's result and the
+        # metrics the worker recorded, without the pending limit of run()
+        return self.start().submit(run_with_metrics, fn, *args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        # Requests beyond max_pending (running + queued) are refused rather than queued forever
+        if self.pending >= self.max_pending:
+            count("qkd_pool_rejected_total")
+            raise PoolSaturated(self.retry_after)
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # The worker's stage timings and counters come back with the result
+            result, collected = await loop.run_in_executor(self.start(),
+                                                           functools.partial(run_with_metrics, fn, *args, **kwargs))
+            merge_metrics(collected)
+            return result
+        finally:
+            self.pending -= 1
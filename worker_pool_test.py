@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+
+from worker_pool import PoolSaturated, WorkerPool
+
+
+def test_pool_runs_functions_in_worker_processes():
+    import os
+    pool = WorkerPool(max_workers=1, max_pending=2)
+    try:
+        assert asyncio.run(pool.run(os.getpid)) != os.getpid()
+        assert pool.pending == 0
+    finally:
+        pool.shutdown()
+
+
+def test_pool_refuses_work_beyond_max_pending():
+    pool = WorkerPool(max_workers=1, max_pending=0, retry_after=3)
+    with pytest.raises(PoolSaturated) as error:
+        asyncio.run(pool.run(sum, [1, 2]))
+    assert error.value.retry_after == 3